@@ -15,34 +15,136 @@ import ansible.playbook
 import ansible.inventory
 
 from ansible import callbacks
+from ansible.inventory.group import Group
+from ansible.inventory.host import Host
 
-from autostack.errors import AnsibleCompoundException
+from autostack.errors import AnsibleCompoundException, AnsibleDispatchError
 from autostack.environment import Compound
-
+from autostack.runner import Runner
+
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+import multiprocessing
+
+from uuid import uuid4
+from collections import OrderedDict, Counter
+from six.moves import queue as Queue
+from multiprocessing.pool import ThreadPool
+from multiprocessing.util import Finalize
 from pkg_resources import parse_version
-from tempfile import NamedTemporaryFile
 
 has_ansible_become = \
     parse_version(ansible.__version__) >= parse_version('1.9.0')
 
+# ansible inventories of the session, keyed by their host set
+_inventories = OrderedDict()
+_inventories_lock = threading.Lock()
+INVENTORY_CACHE_SIZE = 128
+
+# --autostack-forks=auto: ansible workers mostly wait on the network,
+# run several of them per cpu
+FORKS_PER_CPU = 8
+# forks chosen per run, for the terminal summary
+forks_used = Counter()
+
+# --autostack-facts=lazy: the setup filter of what
+# NodeTemplate.get_concrete_class() reads, ansible_os_family and
+# ansible_distribution*, setup takes a single fnmatch pattern
+MINIMAL_FACTS = 'ansible_[do][is]*'
+
+# threads running submit()ted module calls
+EXECUTOR_THREADS = 8
+_executor = None
+_executor_lock = threading.Lock()
+
 
 class AnsibleRunnerCallback(callbacks.DefaultRunnerCallbacks):
     '''
+    Results are buffered and pushed to the queue with put_many() once
+    flush_size results are waiting or flush_interval seconds passed since
+    the last push. Whoever runs the module calls flush() when it's done.
+
     TODO:
     - handle logs
     '''
-    def __init__(self, queue):
+    def __init__(self, queue, flush_size=50, flush_interval=0.5,
+                 recorder=None):
         self._q = queue
+        self._recorder = recorder
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._flushed_at = time.time()
+        self._pid = self._origin = os.getpid()
+        self._published = set()
+
+    def _put(self, item):
+        pid = os.getpid()
+        if pid == self._origin:
+            self._published.add(item['host'])
+        elif not self._q.cross_process:
+            # in-process queues are fed by publish() in the parent
+            return
+        elif self._pid != pid:
+            # ansible runs modules in forked workers which exit on their
+            # own, make sure what they buffered is pushed on their way out
+            self._pid = pid
+            self._buffer = []
+            Finalize(self, self.flush, exitpriority=10)
+        self._buffer.append(item)
+        if len(self._buffer) >= self.flush_size or \
+                time.time() - self._flushed_at >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        items, self._buffer = self._buffer, []
+        if self._recorder is not None:
+            # --autostack-record
+            self._recorder(items)
+        self._q.put_many(items)
+        self._flushed_at = time.time()
+
+    def publish(self, results, published=None):
+        '''
+        Push the successful results of a run that didn't reach the queue
+        from the forked workers, which is the case of in-process queues.
+
+        :param results: runner results, dict(contacted={}, dark={})
+        :param published: hosts whose results already reached the queue,
+            by default the hosts this process published so far
+        '''
+        if self._q.cross_process or not results:
+            return
+        if published is None:
+            published = set(self._published)
+        for host, res in results.get('contacted', {}).items():
+            if host not in published and _succeeded(res):
+                self._put({'host': host, 'result': res})
+        self.flush()
 
     def on_ok(self, host, res):
-        self._q.put({'host': host, 'result': res})
+        self._put({'host': host, 'result': res})
         super(AnsibleRunnerCallback, self).on_ok(host, res)
 
     def on_async_ok(self, host, res, jid):
-        self._q.put({'host': host, 'result': res})
+        self._put({'host': host, 'result': res})
         super(AnsibleRunnerCallback, self).on_async_ok(host, res, jid)
 
 
+def _succeeded(res):
+    # same as ansible.runner.return_data.ReturnData.is_successful()
+    if res.get('failed', False):
+        return False
+    if 'failed_when_result' in res:
+        return not res['failed_when_result']
+    return res.get('rc', 0) == 0
+
+
 class _AnsibleModule(object):
     '''
     Wrapper around ansible.runner.Runner()
@@ -66,10 +168,12 @@ class _AnsibleModule(object):
             return _AnsibleModule(queue=self.queue, **self.options)
 
     @classmethod
-    def _ansible_inventory(cls, nodes):
+    def _ansible_inventory(cls, nodes, cache=True):
         '''
         :params nodes: Compound instance slice from environment
-        translate inventory to Ansible like file:
+        :param cache: reuse the inventory of a previous call with the same
+            host set (address, group, connection, user)
+        translate inventory to an in-memory Ansible inventory:
 
         node1.group = clients
         node1.address = 1.1.1.1
@@ -80,6 +184,8 @@ class _AnsibleModule(object):
         >>> l = [node1, node2]
         >>> _ansible_inventory(l)
 
+        which is equivalent to the Ansible inventory file:
+
         [clients]
         1.1.1.1 connection=smart
 
@@ -87,41 +193,111 @@ class _AnsibleModule(object):
         2.2.2.2 connection=smart
 
 
-        The Ansible like file is relevant only in case of running Playbook.
+        The groups are relevant only in case of running Playbook.
         Running regular module addhoc is calling "all" hard coded.
         '''
         nodes = nodes if isinstance(nodes, list) else Compound([nodes])
-
-        groups = dict()
-
-        for node in nodes:
-            try:
-                groups[node.group].append(node.stripe)
-            except KeyError:
-                groups[node.group] = [node.stripe]
-
-        inventory = ''
-        for grp, hosts in groups.iteritems():
-            inventory += '[{name}]\n{hosts}\n'.format(
-                name=grp, hosts='\n'.join(hosts))
+        key = frozenset((node.address, node.group, node.connection, node.user)
+                        for node in nodes)
+
+        if cache:
+            with _inventories_lock:
+                inventory = _inventories.get(key)
+            if inventory is not None:
+                # undo what a previous run left behind
+                inventory.lift_restriction()
+                inventory.lift_also_restriction()
+                inventory.subset(None)
+                inventory.clear_pattern_cache()
+                return inventory
 
         try:
-            temp = NamedTemporaryFile(delete=False)
-            temp.write(inventory)
-            temp.close()
-            return ansible.inventory.Inventory(temp.name)
+            inventory = _build_inventory(nodes)
         except Exception as err:
             raise pytest.UsageError("Failed to initiate inventory!, "
                                     "error: {0}".format(err))
 
-    def setup_context(self, ctx):
-        self.setup(ctx.all)
+        if cache:
+            with _inventories_lock:
+                _inventories[key] = inventory
+                if len(_inventories) > INVENTORY_CACHE_SIZE:
+                    _inventories.popitem(last=False)
+        return inventory
+
+    def setup_context(self, ctx, refresh=False):
+        '''
+        Gather facts for every node in ctx and resolve their concrete OS.
+        Nodes found in the fact cache (--autostack-fact-cache) skip the
+        remote setup call.
+
+        With --autostack-facts=lazy only MINIMAL_FACTS are gathered, the
+        others are loaded on first access, see _FactLoader.
+
+        :param refresh: gather every node and refresh the fact cache
+        '''
+        nodes = ctx.all
+        lazy = self.options.get('facts') == 'lazy'
+        if lazy:
+            loader = _FactLoader(self)
+            for node in nodes:
+                node._fact_loader = loader
+        cache = self.options.get('fact_cache')
+        if cache is not None and not refresh:
+            misses = Compound()
+            for node in nodes:
+                facts = cache.get(node)
+                if facts is None:
+                    misses.append(node)
+                else:
+                    node._load_setup({'ansible_facts': facts})
+            nodes = misses
+
+        if nodes:
+            args = ['filter={}'.format(MINIMAL_FACTS)] if lazy else []
+            contacted = self.setup(nodes, *args)
+            for node in nodes:
+                try:
+                    result = contacted[node.address]
+                except KeyError:
+                    continue
+                node._load_setup(result)
+                # only complete facts are served from the cache
+                if cache is not None and not lazy:
+                    cache.set(node, result['ansible_facts'])
+            self.barrier()
         ctx.set_concrete_os()
 
+    def forks(self, hosts):
+        '''
+        :param hosts: number of target hosts
+        :return: forks for a run against them, see resolve_forks()
+        '''
+        forks = resolve_forks(self.options.get('forks', 'auto'), hosts,
+                              self.options.get('max_forks'))
+        forks_used[forks] += 1
+        return forks
+
+    def barrier(self, timeout=None):
+        '''
+        Wait until the dispatcher applied every result queued so far.
+
+        :return: False in case the dispatcher didn't catch up in time
+        :raise AnsibleDispatchError: in case result handlers failed
+        '''
+        dispatcher = self.options.get('dispatcher')
+        if dispatcher is None:
+            return True
+        if timeout is None:
+            timeout = self.options.get('dispatch_timeout', 30)
+        flushed = dispatcher.flush(timeout)
+        errors = dispatcher.pop_errors()
+        if errors:
+            raise AnsibleDispatchError(errors)
+        return flushed
+
     def __call__(self, nodes, *args, **kwargs):
         # Initialize ansible inventory manage
         inventory = self._ansible_inventory(nodes)
-        runner_callbacks = AnsibleRunnerCallback(self.queue)
 
         # Assemble module argument string
         module_args = list()
@@ -132,16 +308,61 @@ class _AnsibleModule(object):
         # pop async parameters
         async = kwargs.pop('run_async', False)
         time_limit = kwargs.pop('time_limit', 60)
-        forks = kwargs.pop('forks', C.DEFAULT_FORKS)
+        forks = kwargs.pop('forks', None)
+        stream = kwargs.pop('stream', False)
+        if stream and async:
+            raise ValueError('stream=True is not supported by async runs')
+
+        # pop straggler policy parameters, see Runner
+        policy = dict((key, kwargs.pop(key, None))
+                      for key in ('deadline', 'host_timeout', 'quorum'))
+        # hosts cut off by a quorum or a deadline are expected, the call
+        # returns partial results, a host_timeout marks a failing host
+        partial = bool(policy['quorum'] or policy['deadline'])
+
+        # memoized results are served, only the other hosts run
+        hosts = inventory.list_hosts('all')
+        ttl = self._memo_ttl(kwargs.pop('cache', None))
+        memo = self.options.get('memo')
+        hits = {}
+        if ttl and not (async or stream):
+            hits = memo.get(self.module_name, module_args, kwargs, hosts, ttl)
+            if hits:
+                # the context model gets them as if they just ran
+                self.queue.put_many([{'host': host, 'result': result}
+                                     for host, result in hits.items()])
+                hosts = [host for host in hosts if host not in hits]
+                if not hosts:
+                    return _ExtendedPoller(dict(contacted=hits, dark={}),
+                                           None).poll()
+
+        # async and streamed runs are neither recorded nor replayed
+        key = None
+        if not (async or stream):
+            key = self._call_key('module', hosts, self.module_name,
+                                 module_args, kwargs)
+        elif self._replaying:
+            raise pytest.UsageError(
+                'async and streamed runs can not be replayed')
+        if key is not None and self._replaying:
+            res = self.options['store'].replay(key, self.queue)
+            self._memoize(ttl, hits, module_args, kwargs, res)
+            return _ExtendedPoller(res, None, allow_timeouts=partial).poll()
+        # sized for the hosts that actually run
+        forks = forks or self.forks(len(hosts))
+        runner_callbacks = AnsibleRunnerCallback(
+            self.queue, recorder=self._recorder(key))
 
         # Build module runner object
+        complex_args = kwargs
         kwargs = dict(
             inventory=inventory,
             pattern='all',
+            run_hosts=hosts,
             callbacks=runner_callbacks,
             module_name=self.module_name,
             module_args=module_args,
-            complex_args=kwargs,
+            complex_args=complex_args,
             forks=forks,
             transport=self.options.get('connection'),
             remote_user=self.options.get('user'),
@@ -160,14 +381,41 @@ class _AnsibleModule(object):
                 sudo_user=self.options.get('sudo_user'),)
             )
 
-        runner = ansible.runner.Runner(**kwargs)
+        kwargs.update(policy)
+        runner = Runner(**kwargs)
+        if stream:
+            return _ResultStream(runner, runner_callbacks)
 
         # Run the module
-        if async:
-            res, poll = runner.run_async(time_limit=time_limit)
-            return _ExtendedPoller(res, poll)
-        else:
-            return _ExtendedPoller(runner.run(), None).poll()
+        try:
+            if async:
+                res, poll = runner.run_async(time_limit=time_limit)
+                runner_callbacks.publish(res)
+                return _ExtendedPoller(res, poll, runner_callbacks)
+            else:
+                res = runner.run()
+                runner_callbacks.publish(res)
+        finally:
+            runner_callbacks.flush()
+        if key is not None:
+            self.options['store'].record_return(key, res)
+        self._memoize(ttl, hits, module_args, complex_args, res)
+        return _ExtendedPoller(res, None, allow_timeouts=partial).poll()
+
+    def submit(self, nodes, *args, **kwargs):
+        '''
+        Run the module in a background thread, calls on independent nodes
+        overlap their remote work. Results reach the context model through
+        the queue as they land, like with a blocking call.
+
+        >>> uname = run.command.submit(ctx.hosts, 'uname -a')
+        >>> ping = run.ping.submit(ctx.containers)
+        >>> uname_res, ping_res = gather(uname, ping)
+
+        :return: multiprocessing AsyncResult, get() returns what a
+            blocking call would or raises its exception
+        '''
+        return _get_executor().apply_async(self, (nodes,) + args, kwargs)
 
     def run_playbook(self, env, playbook=None):
         '''
@@ -178,41 +426,470 @@ class _AnsibleModule(object):
         '''
 
         playbook = playbook or self.options.get('playbook')
-        inventory = self._ansible_inventory(env)
+        # playbooks merge group_vars/host_vars of their directory into the
+        # inventory, never share it with other runs
+        inventory = self._ansible_inventory(env, cache=False)
+
+        key = None
+        if self.options.get('store') is not None:
+            with open(playbook, 'rb') as f:
+                digest = hashlib.sha1(f.read()).hexdigest()
+            key = self._call_key('playbook', inventory.list_hosts('all'),
+                                 os.path.abspath(playbook), digest)
+            if self._replaying:
+                return self.options['store'].replay(key, self.queue)
 
         # Make sure we aggregate the stats
         stats = callbacks.AggregateStats()
+        runner_cb = AnsibleRunnerCallback(self.queue,
+                                          recorder=self._recorder(key))
+
+        pb = self._playbook(playbook, inventory, runner_cb, stats)
+        try:
+            summary = pb.run()
+        finally:
+            runner_cb.flush()
+        if key is not None:
+            self.options['store'].record_return(key, summary)
+        return summary
+
+    def _memo_ttl(self, cache):
+        '''
+        :param cache: cache= argument of the call, True/False or seconds
+        :return: seconds memoized results of the call are valid, 0 when
+            the call isn't memoized
+        '''
+        memo = self.options.get('memo')
+        if memo is None or cache is False:
+            return 0
+        if cache is True:
+            return self.options.get('cache_ttl') or memo.ttl
+        if cache is not None:
+            # seconds, 0 turns memoization off like False
+            return cache
+        if self.options.get('cache_ttl'):
+            # @pytest.mark.ansible(cache_ttl=...)
+            return self.options['cache_ttl']
+        if self.module_name in memo.modules:
+            return memo.ttl
+        return 0
+
+    def _memoize(self, ttl, hits, module_args, complex_args, res):
+        '''
+        Keep the successful results of a memoized call and add the
+        results it was served from the memo.
+        '''
+        if not ttl:
+            return
+        self.options['memo'].set(
+            self.module_name, module_args, complex_args,
+            dict((host, result) for host, result in res['contacted'].items()
+                 if _succeeded(result)))
+        res['contacted'].update(hits)
+
+    @property
+    def _replaying(self):
+        store = self.options.get('store')
+        return store is not None and store.replaying
+
+    def _call_key(self, kind, hosts, *parts):
+        '''
+        :param hosts: the target host names
+        :return: --autostack-record/replay key of the call, None when
+            neither is used
+        '''
+        store = self.options.get('store')
+        if store is None:
+            return None
+        return store.key(kind, sorted(hosts), *parts)
+
+    def _recorder(self, key):
+        if key is None:
+            return None
+        return self.options['store'].recorder(key)
+
+    def _playbook(self, playbook, inventory, runner_callbacks, stats,
+                  **kwargs):
         playbook_cb = callbacks.PlaybookCallbacks(
             verbose=ansible.utils.VERBOSITY)
-        runner_cb = AnsibleRunnerCallback(self.queue)
-
-        # TODO: add forks=int
-        pb = ansible.playbook.PlayBook(
+        return ansible.playbook.PlayBook(
             playbook=playbook,
+            forks=self.forks(len(inventory.list_hosts('all'))),
             remote_user=self.options.get('user'),
             callbacks=playbook_cb,
-            runner_callbacks=runner_cb,
+            runner_callbacks=runner_callbacks,
             inventory=inventory,
-            stats=stats
+            stats=stats,
+            **kwargs
         )
-        return pb.run()
+
+    def batch(self, nodes):
+        '''
+        Queue several modules and run them in a single play against nodes,
+        hosts are connected once and run the modules one after the other.
+
+        >>> with run.batch(ctx.hosts) as batch:
+        >>>     ping = batch.ping()
+        >>>     uname = batch.command('uname -a')
+        >>> uname.results['1.1.1.1']['stdout']
+
+        :return: _Batch, runs the queued modules when the with block ends
+        '''
+        return _Batch(self, nodes)
+
+
+def _build_inventory(nodes):
+    inventory = ansible.inventory.Inventory([])
+    all_group = inventory.get_group('all')
+    groups = dict(all=all_group)
+    hosts = dict()
+    for node in nodes:
+        try:
+            group = groups[node.group]
+        except KeyError:
+            group = groups[node.group] = Group(node.group)
+            all_group.add_child_group(group)
+            inventory.add_group(group)
+
+        # same variables as node.stripe of an inventory file
+        host = hosts.get(node.address)
+        if host is None:
+            host = hosts[node.address] = Host(node.address)
+            host.set_variable('connection', node.connection)
+            host.set_variable('ansible_ssh_user', node.user)
+        group.add_host(host)
+    # Inventory() already resolved "all" while it was still empty
+    inventory.clear_pattern_cache()
+    return inventory
+
+
+def resolve_forks(policy, hosts, cap=None):
+    '''
+    :param policy: "auto" or a fixed number of forks
+    :param hosts: number of target hosts
+    :param cap: upper limit of "auto"
+    :return: with "auto" one fork per host, up to FORKS_PER_CPU forks
+        per cpu and cap
+    '''
+    if policy != 'auto':
+        return max(1, int(policy))
+    try:
+        cpus = multiprocessing.cpu_count()
+    except NotImplementedError:
+        cpus = 1
+    forks = min(hosts, cpus * FORKS_PER_CPU)
+    if cap:
+        forks = min(forks, cap)
+    return max(1, forks)
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPool(EXECUTOR_THREADS)
+        return _executor
+
+
+def shutdown_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.close()
+            _executor.join()
+            _executor = None
+
+
+def gather(*results, **kwargs):
+    '''
+    Wait for submit()ted module calls.
+
+    :param timeout: seconds to wait for each of the results
+    :return: list of their results, in the order given
+    :raise: the exception of the first call that failed
+    '''
+    timeout = kwargs.pop('timeout', None)
+    # wait for all of them first, a failure shouldn't leave calls behind
+    for result in results:
+        result.wait(timeout)
+    return [result.get(0) for result in results]
+
+
+def clear_inventory_cache():
+    with _inventories_lock:
+        _inventories.clear()
+
+
+class _FactLoader(object):
+    '''
+    Loads facts missing from lazily gathered nodes, see Facts.prefetch().
+    A key costs one filtered setup call for all the nodes asking for it,
+    keys which are still missing afterwards aren't asked for again.
+    '''
+    def __init__(self, module):
+        self._module = module
+        # (address, key) already asked for
+        self._asked = set()
+        self._lock = threading.Lock()
+
+    def load(self, facts, key):
+        '''
+        :param facts: Facts views which miss key
+        :param key: fact name, e.g. ansible_default_ipv4
+        '''
+        with self._lock:
+            facts = [f for f in facts
+                     if (f._node.address, key) not in self._asked]
+            self._asked.update((f._node.address, key) for f in facts)
+        if not facts:
+            return
+        nodes = OrderedDict((f._node.address, f._node) for f in facts)
+        contacted = self._module.setup(Compound(nodes.values()),
+                                       'filter={}'.format(key))
+        for f in facts:
+            result = contacted.get(f._node.address)
+            if result is not None:
+                f._extend(result['ansible_facts'])
+
+
+class _BatchItem(object):
+    '''
+    A module queued in a _Batch, results is {host: result} once the
+    batch ran.
+    '''
+    def __init__(self, module_name, module_args, complex_args):
+        self.module_name = module_name
+        self.module_args = module_args
+        self.complex_args = complex_args
+        self.results = None
+
+    def task(self, register):
+        task = {self.module_name: self.module_args, 'register': register,
+                'ignore_errors': True}
+        if self.complex_args:
+            task['args'] = self.complex_args
+        return task
+
+
+class _Batch(object):
+    '''
+    Modules queued by attribute calls, see _AnsibleModule.batch().
+    They run as the tasks of one generated play, every result is
+    registered and read back from the playbook vars cache.
+    '''
+    def __init__(self, module, nodes):
+        self._module = module
+        self._nodes = nodes
+        self.items = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def queue(*args, **kwargs):
+            item = _BatchItem(name, ' '.join(args), kwargs)
+            self.items.append(item)
+            return item
+        return queue
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.run()
+
+    @property
+    def results(self):
+        '''
+        :return: [{host: result}] of the queued modules, in their order
+        '''
+        return [item.results for item in self.items]
+
+    def run(self):
+        '''
+        :raise AnsibleCompoundException: in case a module failed on some
+            host or a host was unreachable
+        '''
+        if not self.items:
+            return []
+        module = self._module
+        inventory = module._ansible_inventory(self._nodes)
+        key = module._call_key('batch', inventory.list_hosts('all'),
+                               [item.task(None) for item in self.items])
+        if key is not None and module._replaying:
+            results = module.options['store'].replay(key, module.queue)
+        else:
+            results = self._execute(inventory, module._recorder(key))
+            if key is not None:
+                module.options['store'].record_return(key, results)
+        for item, item_results in zip(self.items, results):
+            item.results = item_results
+
+        failed, dark = {}, {}
+        for item in self.items:
+            for host, res in item.results.items():
+                if res.get('unreachable', False):
+                    dark[host] = res
+                elif not _succeeded(res):
+                    failed.setdefault(host, res)
+        if failed or dark:
+            raise AnsibleCompoundException(
+                'Some of the batched modules had failed',
+                contacted=failed, dark=dark)
+        return self.results
+
+    def _execute(self, inventory, recorder):
+        module = self._module
+        hosts = inventory.list_hosts('all')
+        prefix = 'autostack_batch_{}'.format(uuid4().hex)
+        play = dict(hosts='all', gather_facts=False,
+                    tasks=[item.task('{}_{}'.format(prefix, i))
+                           for i, item in enumerate(self.items)])
+
+        # the inventory is shared with other calls, PlayBook merges the
+        # group_vars and host_vars of the playbook directory into it
+        basedir = tempfile.mkdtemp(prefix='autostack-batch-')
+        playbook = os.path.join(basedir, 'batch.yml')
+        runner_cb = AnsibleRunnerCallback(module.queue, recorder=recorder)
+        stats = callbacks.AggregateStats()
+        kwargs = dict(transport=module.options.get('connection'))
+        if has_ansible_become:
+            kwargs.update(become=module.options.get('become'),
+                          become_method=module.options.get('become_method'),
+                          become_user=module.options.get('become_user'))
+        results = []
+        try:
+            with open(playbook, 'w') as f:
+                # json is valid yaml
+                json.dump([play], f)
+            pb = module._playbook(playbook, inventory, runner_cb, stats,
+                                  **kwargs)
+            pb.run()
+
+            published = set(runner_cb._published)
+            for i in range(len(self.items)):
+                register = '{}_{}'.format(prefix, i)
+                item_results = dict(
+                    (host, pb.VARS_CACHE.get(host, {}).pop(register, None) or
+                     dict(failed=True, unreachable=True))
+                    for host in hosts)
+                runner_cb.publish(dict(contacted=item_results), published)
+                results.append(item_results)
+        finally:
+            runner_cb.flush()
+            shutil.rmtree(basedir)
+        return results
+
+
+class _ResultStream(object):
+    '''
+    Iterates (host, result) pairs of a module run, in the order hosts
+    finish. A failed or unreachable host raises AnsibleCompoundException
+    when its turn comes, iteration can go on with the following hosts.
+
+    >>> for host, res in run.command(ctx.hosts, 'uname -a', stream=True):
+    >>>     assert 'Linux' in res['stdout']
+    '''
+    # seconds between checks for KeyboardInterrupt while waiting
+    POLL = 1
+
+    def __init__(self, runner, callbacks):
+        self.contacted = {}
+        self.dark = {}
+        self.timed_out = {}
+        self._seen = set()
+        self._queue = Queue.Queue()
+        runner.result_hook = self._received
+        worker = threading.Thread(target=self._run, args=(runner, callbacks))
+        worker.daemon = True
+        worker.start()
+
+    def _received(self, return_data):
+        self._queue.put(
+            (return_data.host, return_data.result, return_data.comm_ok))
+
+    def _run(self, runner, callbacks):
+        try:
+            res = runner.run()
+            callbacks.publish(res)
+            # hosts the hook didn't see (e.g. run_once modules)
+            for host, result in res['contacted'].items():
+                self._queue.put((host, result, True))
+            for host, result in res['dark'].items():
+                self._queue.put((host, result, False))
+            for host, result in res.get('timed_out', {}).items():
+                self._queue.put((host, result, False))
+        except Exception as err:
+            self._queue.put(err)
+        finally:
+            callbacks.flush()
+            self._queue.put(None)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=self.POLL)
+            except Queue.Empty:
+                continue
+            if item is None:
+                # stay exhausted
+                self._queue.put(None)
+                raise StopIteration
+            if isinstance(item, Exception):
+                raise item
+            host, result, comm_ok = item
+            if host in self._seen:
+                continue
+            self._seen.add(host)
+            if result.get('timed_out', False):
+                self.timed_out[host] = result
+                raise AnsibleCompoundException(
+                    'Host {} timed out'.format(host), timed_out={host: result})
+            if not comm_ok:
+                self.dark[host] = result
+                raise AnsibleCompoundException(
+                    'Host {} is unreachable'.format(host), dark={host: result})
+            self.contacted[host] = result
+            if result.get('failed', False) or result.get('rc', 0) != 0:
+                raise AnsibleCompoundException(
+                    'Host {} had failed'.format(host),
+                    contacted={host: result})
+            return host, result
+
+    __next__ = next
 
 
 class _ExtendedPoller(object):
-    def __init__(self, result, poller):
+    def __init__(self, result, poller, callbacks=None, allow_timeouts=False):
         self.__res = result
         self.__poll = poller
+        self.__callbacks = callbacks
+        self.__allow_timeouts = allow_timeouts
 
     def __getattr__(self, name):
         return getattr(self.__poll, name)
 
+    @property
+    def timed_out(self):
+        return self.__res.get('timed_out', {})
+
     def __expose_failure(self):
         is_failur = all((res.get('failed', False) or res.get('rc', 0) != 0
                          for host, res in self.__res['contacted'].iteritems()))
-        if is_failur or self.__res['dark']:
+        timed_out = self.__res.get('timed_out') and not self.__allow_timeouts
+        if is_failur or self.__res['dark'] or timed_out:
             raise AnsibleCompoundException(
                 'Some of the hosts had failed', **self.__res)
 
+        if self.timed_out:
+            # partial results, stragglers are marked with timed_out=True
+            contacted = dict(self.__res['contacted'])
+            contacted.update(self.timed_out)
+            return contacted
         return self.__res['contacted']
 
     def poll(self):
@@ -222,16 +899,30 @@ class _ExtendedPoller(object):
             return self.__expose_failure()
 
     def wait(self, seconds, poll_interval):
-        self.__res = self.__poll.wait(seconds, poll_interval)
+        try:
+            self.__res = self.__poll.wait(seconds, poll_interval)
+        finally:
+            if self.__callbacks is not None:
+                self.__callbacks.flush()
         return self.__expose_failure()
 
 
-def initialize_ansible(request, queue):
+def initialize_ansible(request, queue, fact_cache=None, dispatcher=None,
+                       store=None, memo=None):
 
     _request = request
     # Remember the pytest request attr
     kwargs = dict(__request__=request)
     kwargs['queue'] = queue
+    kwargs['fact_cache'] = fact_cache
+    kwargs['dispatcher'] = dispatcher
+    kwargs['store'] = store
+    kwargs['memo'] = memo
+    kwargs['dispatch_timeout'] = \
+        _request.config.getvalue('autostack_dispatch_timeout')
+    kwargs['forks'] = _request.config.getvalue('autostack_forks')
+    kwargs['max_forks'] = _request.config.getvalue('autostack_max_forks')
+    kwargs['facts'] = _request.config.getvalue('autostack_facts')
 
     # Grab options from command-line
     option_names = ['ansible_playbook',
@@ -260,6 +951,8 @@ def initialize_ansible(request, queue):
                 if mark.name == 'ansible':
                     ansible_args = mark.kwargs
 
+    kwargs['cache_ttl'] = ansible_args.get('cache_ttl')
+
     # Build kwargs to pass along to AnsibleModule
     for key in option_names:
         try:
@@ -6,6 +6,10 @@ from __future__ import (absolute_import, division, print_function,
 
 import threading
 import time
+import traceback
+
+from six.moves import queue as Queue
+from autostack.utils import RegisterHandlers
 
 
 __author__ = 'Avi Tal <avi3tal@gmail.com>'
@@ -13,32 +17,165 @@ __date__ = 'Sep 9, 2015'
 
 
 class Dispatcher(threading.Thread):
-    def __init__(self, queue, ctx):
+    '''
+    Applies queued module results to the nodes of a context.
+
+    The thread sleeps in a blocking queue read and wakes up as soon as
+    results arrive. flush() is a barrier for everything queued so far and
+    stop() drains the queue before the thread exits.
+
+    With workers > 1 results are applied by a pool of worker threads,
+    sharded by host address: results of the same host are applied in
+    order while different hosts are handled in parallel.
+    '''
+    # seconds between checks of the active flag while the queue is idle
+    POLL_TIMEOUT = 1
+
+    def __init__(self, queue, ctx, batch_size=100, workers=1):
         super(Dispatcher, self).__init__()
         self._q = queue
         self.inventory = ctx
         self.active = True
+        self.batch_size = batch_size
+        self._applied = 0
+        self._applied_cond = threading.Condition()
+        self._shards = [Queue.Queue() for _ in range(workers)] \
+            if workers > 1 else []
+        self._stats_lock = threading.Lock()
+        # module name -> [count, total seconds, max seconds]
+        self._latency = {}
+        self.max_depth = 0
+        self._errors = []
 
     def _dispatch(self, host, result):
-        # FIXME: dispatch objects due to object model
-        node = self.inventory.all.filter(address=host)[0]
         try:
-            getattr(node, '_load_' + result['invocation']['module_name'])(result)
-        except AttributeError:
-            pass
+            node = self.inventory.by_address(host)
+        except KeyError:
+            # result of a host which isn't part of the context
+            return
+        module_name = result['invocation']['module_name']
+        handler = RegisterHandlers.table.get((type(node), module_name))
+        if handler is None:
+            # the node model doesn't care about this module
+            return
+        started = time.time()
+        try:
+            handler(node, result)
+        except Exception:
+            with self._stats_lock:
+                self._errors.append(
+                    (host, module_name, traceback.format_exc()))
+            return
+        self._record(module_name, time.time() - started)
+
+    def pop_errors(self):
+        '''
+        :return: list of (host, module name, formatted traceback) of the
+            handlers which failed since the last call
+        '''
+        with self._stats_lock:
+            errors, self._errors = self._errors, []
+        return errors
+
+    def _record(self, module_name, elapsed):
+        with self._stats_lock:
+            stats = self._latency.setdefault(module_name, [0, 0.0, 0.0])
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+
+    def _mark_applied(self, count):
+        with self._applied_cond:
+            self._applied += count
+            self._applied_cond.notify_all()
 
     def run(self):
-        while self.active:
-            msg = self._q.get(timeout=60)
-            if msg is None:
-                time.sleep(5)
-                continue
-            if msg == 'goodbye':
-                self.close()
-            else:
-                # TODO: handle eval exception
-                if isinstance(msg, dict):
+        workers = [threading.Thread(target=self._work, args=(shard,))
+                   for shard in self._shards]
+        for worker in workers:
+            worker.daemon = True
+            worker.start()
+        try:
+            while self.active:
+                batch = self._q.get_batch(self.batch_size,
+                                          timeout=self.POLL_TIMEOUT)
+                if batch:
+                    self._route(batch)
+        finally:
+            for shard in self._shards:
+                shard.put(None)
+            for worker in workers:
+                worker.join()
+
+    def _route(self, batch):
+        self.max_depth = max(self.max_depth, len(batch) + sum(
+            shard.qsize() for shard in self._shards))
+        inline = 0
+        try:
+            for msg in batch:
+                if self._shards and isinstance(msg, dict):
+                    shard = hash(msg['host']) % len(self._shards)
+                    self._shards[shard].put(msg)
+                    continue
+                inline += 1
+                if msg == 'goodbye':
+                    self.close()
+                elif isinstance(msg, dict):
                     self._dispatch(**msg)
+        finally:
+            self._mark_applied(inline)
+
+    def _work(self, shard):
+        while True:
+            msg = shard.get()
+            if msg is None:
+                return
+            try:
+                self._dispatch(**msg)
+            finally:
+                self._mark_applied(1)
+
+    def depth(self):
+        '''
+        Number of results waiting in the queue and in the worker shards.
+        '''
+        return len(self._q) + sum(shard.qsize() for shard in self._shards)
+
+    def stats(self):
+        '''
+        :return: dict(applied=int, max_depth=int, handlers={module_name:
+            dict(count=int, total=seconds, max=seconds)})
+        '''
+        with self._stats_lock:
+            handlers = dict(
+                (name, dict(count=count, total=total, max=longest))
+                for name, (count, total, longest) in self._latency.items())
+        return dict(applied=self._applied, max_depth=self.max_depth,
+                    handlers=handlers)
+
+    def flush(self, timeout=30):
+        '''
+        Block until every message put into the queue so far was applied.
+
+        :return: False in case of timeout or if the dispatcher is dead
+        '''
+        target = self._q.produced()
+        deadline = time.time() + timeout
+        with self._applied_cond:
+            while self._applied < target:
+                remaining = deadline - time.time()
+                if remaining <= 0 or not self.is_alive():
+                    return False
+                self._applied_cond.wait(min(remaining, self.POLL_TIMEOUT))
+        return True
+
+    def stop(self, timeout=30):
+        '''
+        Apply whatever is queued and stop, waiting at most timeout seconds.
+        '''
+        if self.is_alive():
+            self._q.join()
+            self.join(timeout)
 
     def close(self):
         self.active = False
@@ -3,23 +3,38 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+import os
+import six
 import yaml
 import pytest
+import hashlib
 
-from autostack.nodes import NodeTemplate
+from autostack.nodes import NodeTemplate, Facts, _BaseNode
 import grp
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
 class Compound(list):
     '''
     '''
+    # bumped by every in-place change, lets owners cache derived data
+    _version = 0
+    # minimal size for building filter() indexes, None disables them
+    INDEX_THRESHOLD = 64
+
     def __call__(self, *args, **kwargs):
         return Compound([child(*args, **kwargs)
                          for child in super(Compound, self).__iter__()])
 
     def __getattr__(self, item):
-        return Compound([getattr(child, item)
-                         for child in super(Compound, self).__iter__()])
+        children = list(super(Compound, self).__iter__())
+        # facts missing from lazily gathered nodes are loaded all at once
+        Facts.prefetch(children, item)
+        return Compound([getattr(child, item) for child in children])
 
     def __delattr__(self, item):
         [delattr(child, item) for child in super(Compound, self).__iter__()]
@@ -36,35 +51,359 @@ class Compound(list):
         iterable = super(Compound, self).__add__(y)
         return Compound(iterable)
 
+    # Set algebra keeps the order of the left operand followed by the new
+    # items of the right one, "-" and "&" keep duplicates of the left
+    # operand while "|" and "^" return every item once.
     def __sub__(self, other):
-        iterable = [item for item in self if item not in other]
-        return Compound(iterable)
+        contains = _membership(other)
+        return Compound([item for item in self if not contains(item)])
+
+    def __and__(self, other):
+        contains = _membership(other)
+        return Compound([item for item in self if contains(item)])
+
+    def __or__(self, other):
+        return Compound(_unique(self, other))
+
+    def __xor__(self, other):
+        other = list(other)
+        in_other, in_self = _membership(other), _membership(self)
+        return Compound(_unique(
+            [item for item in self if not in_other(item)],
+            [item for item in other if not in_self(item)]))
+
+    def __rsub__(self, other):
+        return Compound(other) - self
+
+    def __rand__(self, other):
+        return Compound(other) & self
+
+    def __ror__(self, other):
+        return Compound(other) | self
+
+    def __rxor__(self, other):
+        return Compound(other) ^ self
+
+    def __isub__(self, other):
+        self[:] = self - other
+        return self
+
+    def __iand__(self, other):
+        self[:] = self & other
+        return self
+
+    def __ior__(self, other):
+        self[:] = self | other
+        return self
+
+    def __ixor__(self, other):
+        self[:] = self ^ other
+        return self
+
+    def filter(self, *any_of, **kwargs):
+        '''
+        Select children in a single pass, keeping their order.
+
+        Keyword arguments are AND-ed, positional dicts are alternatives
+        that are OR-ed, and both can be combined.
+        A key is an attribute path, "__" steps into attributes or dict keys
+        (facts__distribution), an optional suffix selects the operator:
+        "__in" for membership and "__ne" for inequality.
+        A callable value is used as a predicate on the attribute value.
+        Children missing an attribute never match.
+
+        >>> ctx.all.filter(group='hosts')
+        >>> ctx.all.filter(facts__os_family__in=['RedHat', 'Debian'],
+        ...                address__ne='127.0.0.1')
+        >>> ctx.all.filter({'group': 'hosts'}, {'group': 'local'})
+        >>> ctx.all.filter(address=lambda ip: ip.startswith('10.'))
+
+        Equality and membership conditions are served from per-attribute
+        hash indexes once the Compound has INDEX_THRESHOLD children, for
+        Compounds of nodes and facts whose changes are tracked.
+
+        :raise TypeError: in case an "__in" value isn't a collection
+        '''
+        required = _conditions(kwargs)
+        alternatives = [_conditions(alt) for alt in any_of]
+        _prefetch(list(super(Compound, self).__iter__()),
+                  [required] + alternatives)
+
+        candidates = self._candidates(required)
+        if candidates is None and alternatives:
+            candidates = set()
+            for conditions in alternatives:
+                found = self._candidates(conditions)
+                if found is None:
+                    candidates = None
+                    break
+                candidates.update(found)
+
+        if candidates is None:
+            children = super(Compound, self).__iter__()
+        else:
+            get = super(Compound, self).__getitem__
+            children = [get(i) for i in sorted(candidates)]
+
+        return Compound(
+            [child for child in children
+             if _match(child, required) and
+             (not alternatives or
+              any(_match(child, alt) for alt in alternatives))])
 
-    def _filter(self, nodes, key, value):
-        sub = []
-        for child in nodes:
+    def _candidates(self, conditions):
+        '''
+        :return: positions of children that may match, None means all
+        '''
+        if self.INDEX_THRESHOLD is None or len(self) < self.INDEX_THRESHOLD:
+            return None
+        found = None
+        for path, op, value in conditions:
+            if op not in ('eq', 'in') or callable(value):
+                continue
+            index = self._index(path)
+            if index is None:
+                continue
             try:
-                if getattr(child, key) == value:
-                    sub.append(child)
-            except AttributeError:
+                if op == 'eq':
+                    hits = set(index.get(value, ()))
+                else:
+                    hits = set()
+                    for item in value:
+                        hits.update(index.get(item, ()))
+            except TypeError:
+                # unhashable lookup value
                 continue
-        return Compound(sub)
+            found = hits if found is None else found & hits
+            if not found:
+                break
+        return found
+
+    def _index(self, path):
+        state = (self._version, _BaseNode._generation)
+        indexes = self.__dict__.get('_indexes')
+        if indexes is None or indexes[0] != state:
+            indexes = self.__dict__['_indexes'] = (state, {})
+        try:
+            return indexes[1][path]
+        except KeyError:
+            pass
+
+        index = {}
+        for i, child in enumerate(super(Compound, self).__iter__()):
+            if not isinstance(child, (_BaseNode, Facts)):
+                # changes of other objects would go unnoticed
+                index = None
+                break
+            value = _resolve(child, path)
+            if value is _MISSING:
+                continue
+            try:
+                index.setdefault(value, []).append(i)
+            except TypeError:
+                # unhashable attribute values can't be indexed
+                index = None
+                break
+        indexes[1][path] = index
+        return index
+
+
+def _membership(items):
+    '''
+    :return: a membership test for items, hash based unless some of the
+        items are unhashable
+    '''
+    items = list(items)
+    try:
+        lookup = set(items)
+    except TypeError:
+        return items.__contains__
+
+    def contains(item):
+        try:
+            return item in lookup
+        except TypeError:
+            return item in items
+    return contains
+
+
+def _unique(*iterables):
+    seen, unique = set(), []
+    for iterable in iterables:
+        for item in iterable:
+            try:
+                if item in seen:
+                    continue
+                seen.add(item)
+            except TypeError:
+                if item in unique:
+                    continue
+            unique.append(item)
+    return unique
+
+
+_MISSING = object()
+_OPERATORS = ('in', 'ne')
 
-    def filter(self, **kwargs):
-        '''Filter, support only AND mode'''
-        nodes = self
-        for k, v in kwargs.iteritems():
-            nodes = self._filter(nodes, k, v)
-        return nodes
+
+def _conditions(kwargs):
+    conditions = []
+    for key, value in kwargs.items():
+        path = key.split('__')
+        op = 'eq'
+        if len(path) > 1 and path[-1] in _OPERATORS:
+            op = path.pop()
+        if op == 'in' and not callable(value) and (
+                isinstance(value, (six.string_types, bytes)) or
+                not hasattr(value, '__iter__')):
+            raise TypeError('{} expects a collection, got {!r}'.format(
+                key, value))
+        conditions.append((tuple(path), op, value))
+    return conditions
+
+
+def _resolve(obj, path):
+    for attr in path:
+        if isinstance(obj, dict) and attr in obj:
+            obj = obj[attr]
+            continue
+        try:
+            obj = getattr(obj, attr)
+        except (AttributeError, KeyError):
+            return _MISSING
+    return obj
+
+
+def _lazy(child):
+    if isinstance(child, Facts):
+        child = child._node
+    return getattr(child, '_fact_loader', None) is not None
+
+
+def _prefetch(children, conditions):
+    '''
+    Load the facts the conditions refer to for all lazily gathered
+    children at once, instead of a remote call per child while matching.
+    '''
+    if not any(_lazy(child) for child in children):
+        return
+    for path in set(path for alt in conditions for path, _, _ in alt):
+        level = children
+        for attr in path:
+            Facts.prefetch(level, attr)
+            level = [value for value in (_resolve(obj, (attr,))
+                                         for obj in level)
+                     if value is not _MISSING]
+
+
+def _match(child, conditions):
+    for path, op, value in conditions:
+        attr = _resolve(child, path)
+        if attr is _MISSING:
+            return False
+        if callable(value):
+            matched = value(attr)
+        elif op == 'in':
+            matched = attr in value
+        elif op == 'ne':
+            matched = attr != value
+        else:
+            matched = attr == value
+        if not matched:
+            return False
+    return True
+
+
+def _mutator(name):
+    method = getattr(list, name)
+
+    def wrapper(self, *args, **kwargs):
+        # Compound.__setattr__ is broadcast to the children
+        self.__dict__['_version'] = self._version + 1
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = str(name)
+    return wrapper
+
+
+for _name in ('append', 'extend', 'insert', 'remove', 'pop', 'sort',
+              'reverse', '__setitem__', '__delitem__', '__setslice__',
+              '__delslice__', '__iadd__', '__imul__'):
+    if hasattr(list, _name):
+        setattr(Compound, _name, _mutator(_name))
 
 
 class Context(dict):
+    def __init__(self, *args, **kwargs):
+        super(Context, self).__init__()
+        # (mutations, address -> nodes of all groups), see by_address()
+        self._addresses = None
+        self._version = 0
+        self._all = None
+        self.update(*args, **kwargs)
+
     @property
     def all(self):
-        all_set = set()
-        for _, hosts in self.iteritems():
-            all_set |= set(hosts)
-        return Compound(all_set)
+        '''
+        All nodes of every group, each node once, ordered by group name
+        and then by its position in the group.
+        The result is cached until the Context or one of its groups
+        changes, so don't modify it in place.
+        '''
+        version = self._state()
+        if self._all is not None:
+            cached_version, nodes = self._all
+            if cached_version == (version, nodes._version):
+                return nodes
+
+        nodes, seen = Compound(), set()
+        for key in sorted(self):
+            hosts = super(Context, self).__getitem__(key)
+            if isinstance(hosts, Context):
+                hosts = hosts.all
+            for node in hosts:
+                if id(node) not in seen:
+                    seen.add(id(node))
+                    list.append(nodes, node)
+        self._all = ((version, nodes._version), nodes)
+        return nodes
+
+    def _state(self):
+        '''
+        Key that changes with every mutation of this Context and of
+        everything in it. Groups are identified by the object they are,
+        a replaced group starts a new Compound._version from 0.
+        '''
+        return (self._version, tuple(
+            (key, id(value), value._state() if isinstance(value, Context)
+             else value._version)
+            for key, value in sorted(self.iteritems())))
+
+    def by_address(self, address):
+        '''
+        Constant time lookup of a node by its address.
+        The index covers the groups of this Context, nested Context values
+        keep their own index. It is rebuilt on the first lookup after the
+        Context or one of its groups changed, in-place changes included.
+
+        :raise KeyError: in case no node has this address
+        '''
+        version = self._state()
+        indexed = self._addresses
+        if indexed is None or indexed[0] != version:
+            indexed = self._addresses = (version, self._build_index())
+        return indexed[1][address][0]
+
+    def _build_index(self):
+        addresses = {}
+        for key in sorted(self):
+            value = super(Context, self).__getitem__(key)
+            if isinstance(value, Context):
+                continue
+            for node in value:
+                address = getattr(node, 'address', None)
+                if address is not None:
+                    addresses.setdefault(address, []).append(node)
+        return addresses
 
     def __getattr__(self, item):
         try:
@@ -76,22 +415,81 @@ class Context(dict):
         if not isinstance(value, Context):
             value = Compound(value)
         super(Context, self).__setitem__(key, value)
+        self._version += 1
+
+    def __delitem__(self, key):
+        super(Context, self).__delitem__(key)
+        self._version += 1
+
+    def update(self, *args, **kwargs):
+        for key, value in dict(*args, **kwargs).iteritems():
+            self[key] = value
+
+    def setdefault(self, key, default=None):
+        if key not in self:
+            self[key] = default if default is not None else []
+        return self[key]
+
+    def pop(self, key, *args):
+        if key in self:
+            self._version += 1
+        return super(Context, self).pop(key, *args)
+
+    def popitem(self):
+        key, value = super(Context, self).popitem()
+        self._version += 1
+        return key, value
+
+    def clear(self):
+        super(Context, self).clear()
+        self._version += 1
 
     def set_concrete_os(self):
-        for k, v in self.iteritems():
+        for k, v in self.items():
             try:
-                self.update([(k, v.get_concrete_class())])
+                self[k] = v.get_concrete_class()
             except AttributeError:
                 # ignore non NodeTemplate objects
                 pass
+
+
+class InventoryFile(object):
+    '''
+    The --inventory yaml file, parsed once and parsed again only when its
+    content changes. A changed mtime or size alone costs a sha1 of the
+    file, not a yaml parse.
+    '''
+    def __init__(self):
+        self.data = None
+        self._stamp = None
+        self._digest = None
+
+    def load(self, path):
+        stat = os.stat(path)
+        stamp = (path, stat.st_mtime, stat.st_size)
+        if stamp == self._stamp:
+            return self.data
+
+        with open(path, 'rb') as f:
+            raw = f.read()
+        digest = hashlib.sha1(raw).hexdigest()
+        if digest != self._digest:
+            self.data = yaml.load(raw, Loader=SafeLoader)
+            self._digest = digest
+        self._stamp = stamp
+        return self.data
+
+
 ctx = Context()
+inventory_file = InventoryFile()
+# host group name -> inventory data its ctx model was built from
+_sources = {}
 
 
 def initialize_context(request, name='', clear=False):
     global ctx
 
-    with open(request.config.getvalue('inventory'), 'r') as f:
-        data = yaml.load(f)
+    data = inventory_file.load(request.config.getvalue('inventory'))
 
     if not name:
         # in case of None, choose to use the "default" key from
@@ -101,6 +499,20 @@ def initialize_context(request, name='', clear=False):
         except KeyError:
             raise pytest.UsageError('Failed to locate DEFAULT host group')
 
+    try:
+        source = data[name]
+    except KeyError:
+        raise pytest.UsageError(
+            'Unknown {} host group! Could not find in inventory file'.format(
+                name))
+
+    if name in ctx and source is not _sources.get(name):
+        # the inventory file was parsed again, keep the model (and its
+        # gathered facts) unless the host group itself changed
+        if source != _sources.get(name):
+            clear = True
+        _sources[name] = source
+
     if clear:
         # make sure to create new context
         try:
@@ -112,16 +524,12 @@ def initialize_context(request, name='', clear=False):
         # only verify that name exists in ctx
         ctx[name]
     except KeyError:
-        try:
-            _ctx = Context()
-            for grp, hosts in data[name].iteritems():
-                _ctx[grp] = [NodeTemplate(group=grp, **kw) for kw in hosts]
+        _ctx = Context()
+        for grp, hosts in source.iteritems():
+            _ctx[grp] = [NodeTemplate(group=grp, **kw) for kw in hosts]
 
-            print(_ctx)
-            ctx[name] = _ctx
-
-        except KeyError:
-            raise pytest.UsageError(
-                'Unknown {} host group! Could not find in inventory file')
+        print(_ctx)
+        ctx[name] = _ctx
+        _sources[name] = source
 
     return ctx[name]
@@ -12,32 +12,46 @@ class AnsibleNoHostsMatch(ansible.errors.AnsibleError):
     pass
 
 
+class AnsibleNotRecorded(ansible.errors.AnsibleError):
+    pass
+
+
 class AnsibleCompoundException(ansible.errors.AnsibleError):
     '''
     :summary: A general exception that is raised when you have multiple
         hosts and at least one had an exception.
     '''
-    def __init__(self, msg, dark=None, contacted=None):
+    def __init__(self, msg, dark=None, contacted=None, timed_out=None):
         '''
         :param routines: The list of routines that some of them had exceptions.
+        :param timed_out: hosts cut off by a deadline, host_timeout or quorum
         '''
         contacted = contacted or {}
         dark = dark or {}
+        timed_out = timed_out or {}
 
         exceptions_msg = [self._format_host_exception(host, res) for
                           host, res in contacted.iteritems()
                           if res.get('failed', False) or res.get('rc', 0) != 0]
         exceptions_msg.extend([self._format_host_exception(host, res, 'Unreachable')
                                for host, res in dark.iteritems()])
+        exceptions_msg.extend([
+            self._format_host_exception(host, res, 'Timed out')
+            for host, res in timed_out.iteritems()])
         exceptions_msg = ''.join((msg, '\nInner exceptions:\n\n',
                                  '\n'.join(exceptions_msg)))
         super(AnsibleCompoundException, self).__init__(exceptions_msg)
         self._contacted = contacted
+        self._timed_out = timed_out
 
     @property
     def contacted(self):
         return self._contacted
 
+    @property
+    def timed_out(self):
+        return self._timed_out
+
     @staticmethod
     def _format_host_exception(host, res, msg=''):
         '''
@@ -49,3 +63,18 @@ class AnsibleCompoundException(ansible.errors.AnsibleError):
         footer = '<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<<'
         return '\n'.join(
             (header, '{} Host: {}'.format(msg, host), pprint.pformat(res), footer))
+
+
+class AnsibleDispatchError(ansible.errors.AnsibleError):
+    '''
+    :summary: Raised when result handlers of the dispatcher failed.
+    '''
+    def __init__(self, errors):
+        '''
+        :param errors: list of (host, module name, formatted traceback)
+        '''
+        msg = '\n'.join('{} result of host {} failed:\n{}'.format(
+            module_name, host, tb) for host, module_name, tb in errors)
+        super(AnsibleDispatchError, self).__init__(
+            'Failed to apply results\n' + msg)
+        self.errors = errors
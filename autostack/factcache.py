@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import json
+import time
+import errno
+import hashlib
+import tempfile
+
+
+class FactCache(object):
+    '''
+    On-disk cache of ansible facts that survives between py.test runs.
+
+    Every host is stored in its own compact JSON file, named after the
+    host address, connection and user, so changing how we connect to a
+    host never serves facts gathered through another connection.
+
+    >>> cache = FactCache('/tmp/facts', ttl=3600)
+    >>> cache.set(node, facts)
+    >>> cache.get(node)
+    '''
+    def __init__(self, path, ttl=0):
+        '''
+        :param path: directory to keep the cache files in
+        :param ttl: seconds a cached entry stays valid, 0 means forever
+        '''
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        try:
+            os.makedirs(self.path)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+
+    @staticmethod
+    def key(node):
+        stripe = '{0.address}|{0.connection}|{0.user}'.format(node)
+        return hashlib.sha1(stripe.encode('utf-8')).hexdigest()
+
+    def _filename(self, node):
+        return os.path.join(self.path, '{}.json'.format(self.key(node)))
+
+    def _expired(self, filename):
+        if self.ttl <= 0:
+            return False
+        return time.time() - os.path.getmtime(filename) >= self.ttl
+
+    def get(self, node):
+        '''
+        :return: the cached ansible_facts dict or None on a miss
+        '''
+        filename = self._filename(node)
+        try:
+            if self._expired(filename):
+                os.remove(filename)
+                raise IOError(errno.ENOENT, 'expired', filename)
+            with open(filename, 'r') as f:
+                facts = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return facts
+
+    def set(self, node, facts):
+        # write to a temp file first so concurrent runs never read
+        # a partially written entry
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(facts, f, separators=(',', ':'))
+            os.rename(tmp, self._filename(node))
+        except Exception:
+            os.remove(tmp)
+            raise
+
+    def delete(self, node):
+        try:
+            os.remove(self._filename(node))
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.json'):
+                os.remove(os.path.join(self.path, name))
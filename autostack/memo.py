@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import time
+import threading
+
+from collections import OrderedDict
+
+
+class ResultMemo(object):
+    '''
+    LRU of successful module results per host, for read-only modules
+    (setup, stat, ping, command: cat ...) repeated within a session.
+
+    Entries are keyed by (module_name, module_args, complex_args, host)
+    and are served for as long as the caller's ttl allows.
+
+    >>> memo = ResultMemo(size=4096, ttl=300, modules=['stat'])
+    >>> memo.set('stat', '', {'path': '/etc/hosts'}, {'1.1.1.1': {...}})
+    >>> memo.get('stat', '', {'path': '/etc/hosts'}, ['1.1.1.1'], ttl=60)
+    '''
+    def __init__(self, size=4096, ttl=300, modules=()):
+        '''
+        :param size: maximal number of host results kept
+        :param ttl: default seconds a result is served
+        :param modules: modules memoized without asking for it
+        '''
+        self.size = size
+        self.ttl = ttl
+        self.modules = frozenset(modules)
+        self.hits = 0
+        self.misses = 0
+        # key -> (stored at, result)
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(module_name, module_args, complex_args, host):
+        return (module_name, module_args,
+                json.dumps(complex_args, sort_keys=True), host)
+
+    def get(self, module_name, module_args, complex_args, hosts, ttl):
+        '''
+        :return: {host: result} of the hosts with a result younger
+            than ttl seconds
+        '''
+        now = time.time()
+        found = {}
+        with self._lock:
+            for host in hosts:
+                key = self._key(module_name, module_args, complex_args, host)
+                entry = self._entries.pop(key, None)
+                if entry is None or now - entry[0] >= ttl:
+                    self.misses += 1
+                    continue
+                # most recently used go last
+                self._entries[key] = entry
+                found[host] = entry[1]
+                self.hits += 1
+        return found
+
+    def set(self, module_name, module_args, complex_args, results):
+        '''
+        :param results: {host: result}
+        '''
+        now = time.time()
+        with self._lock:
+            for host, result in results.items():
+                key = self._key(module_name, module_args, complex_args, host)
+                self._entries.pop(key, None)
+                self._entries[key] = (now, result)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -4,35 +4,162 @@
 from __future__ import (absolute_import, division, print_function,
                         unicode_literals)
 
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+
+import shlex
+
 from six import with_metaclass
-from autostack.utils import RegisterClasses
+from autostack.utils import RegisterClasses, RegisterHandlers
 from autostack.constants import *
 
 
-class Facts(dict):
+class Facts(Mapping):
+    '''
+    Read-only view over an ansible_facts payload, nothing is copied.
+    Attributes resolve to the key itself or to its "ansible_" prefixed
+    form, nested dicts are returned as views too.
+
+    >>> facts.default_ipv4.address  # facts['ansible_default_ipv4']['address']
+
+    Facts of a lazily gathered node (--autostack-facts=lazy) hold only a
+    subset, missing keys are loaded on first access by the node's
+    _fact_loader.
+    '''
     PREF = 'ansible_'
 
-    def __getattr__(self, attr):
+    def __init__(self, data, node=None):
+        '''
+        :param data: ansible_facts dict
+        :param node: node whose missing facts are loaded on demand
+        '''
+        self._data = data
+        self._node = node
+        # nested views, built on first access
+        self._views = {}
+
+    def __getitem__(self, key):
+        view = self._views.get(key)
+        if view is not None:
+            return view
         try:
-            data = self[attr]
+            data = self._data[key]
         except KeyError:
-            if attr.startswith(self.PREF):
+            loader = getattr(self._node, '_fact_loader', None)
+            if loader is None:
                 raise
-            attr = '{}{}'.format(self.PREF, attr)
-            data = getattr(self, attr)
+            loader.load([self], key)
+            data = self._data[key]
         if isinstance(data, dict):
-            data = Facts(data)
+            data = self._views[key] = Facts(data)
         return data
 
+    def _key(self, attr):
+        if attr in self._data or attr.startswith(self.PREF):
+            return attr
+        return '{}{}'.format(self.PREF, attr)
+
+    def __getattr__(self, attr):
+        if attr.startswith('_'):
+            raise AttributeError(attr)
+        value = self[self._key(attr)]
+        # resolved once, following reads are plain attribute lookups
+        self.__dict__[attr] = value
+        return value
+
+    def _extend(self, facts):
+        '''
+        Add facts loaded on demand, readers of this view see them at once.
+        '''
+        data = dict(self._data)
+        data.update(facts)
+        self._data = data
+        _BaseNode._generation += 1
+
+    @classmethod
+    def prefetch(cls, children, attr):
+        '''
+        Load attr into every lazily gathered Facts among children that
+        misses it, with a single call per loader, so reading an attribute
+        of a whole Compound costs one remote call and not one per node.
+        '''
+        if attr.startswith('_') or hasattr(cls, attr):
+            # methods and class attributes aren't facts
+            return
+        missing = {}
+        for child in children:
+            if not isinstance(child, Facts):
+                continue
+            loader = getattr(child._node, '_fact_loader', None)
+            if loader is None:
+                continue
+            key = child._key(attr)
+            if key not in child._data:
+                missing.setdefault((loader, key), []).append(child)
+        for (loader, key), facts in missing.items():
+            loader.load(facts, key)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, Facts):
+            other = other._data
+        return self._data == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._data)
+
+
+def _module_args(result):
+    '''
+    :return: dict of the key=value arguments the module was invoked with
+    '''
+    invocation = result.get('invocation', {})
+    args = dict(invocation.get('module_complex_args') or {})
+    for token in shlex.split(invocation.get('module_args') or ''):
+        key, sep, value = token.partition('=')
+        if sep:
+            args[key] = value
+    return args
+
+
+class _BaseNode(with_metaclass(RegisterHandlers, object)):
+    '''
+    Results of module <name> are applied by the _load_<name> method,
+    see RegisterHandlers.
+    '''
+    # bumped whenever an attribute or the facts of any node change, see
+    # Compound.filter()
+    _generation = 0
 
-class _BaseNode(object):
     def __init__(self, address, **kwargs):
         self.address = address
         self.connection = kwargs.get('connection', 'smart')
         self.user = kwargs.get('user', 'root')
         self._facts = None
+        # loads facts missing from a lazily gathered subset
+        self._fact_loader = None
+        self._stats = {}
         self._grp = kwargs.get('group', 'all')
 
+    def __setattr__(self, name, value):
+        super(_BaseNode, self).__setattr__(name, value)
+        _BaseNode._generation += 1
+
     def __repr__(self):
         repr_template = ("<{0.__class__.__module__}.{0.__class__.__name__}"
                          " object at {1} | node ip {2}>")
@@ -46,9 +173,42 @@ class _BaseNode(object):
     def group(self):
         return self._grp
 
+    @property
+    def stats(self):
+        '''
+        stat module results by path
+
+        >>> node.stats['/etc/hosts']['exists']
+        '''
+        return self._stats
+
+    def _facts_view(self, facts):
+        return Facts(facts, node=self if self._fact_loader else None)
+
     def _load_setup(self, data):
+        if _module_args(data).get('filter', '*') != '*':
+            # a subset of the facts, e.g. loaded by the _fact_loader
+            self._merge_facts(data['ansible_facts'])
+            return
+        self._fact_loader = None
         self._facts = Facts(data['ansible_facts'])
 
+    def _merge_facts(self, facts):
+        if self._facts is not None:
+            merged = dict(self._facts._data)
+            merged.update(facts)
+            facts = merged
+        self._facts = self._facts_view(facts)
+
+    def _load_package_facts(self, data):
+        self._merge_facts(data['ansible_facts'])
+
+    def _load_service_facts(self, data):
+        self._merge_facts(data['ansible_facts'])
+
+    def _load_stat(self, data):
+        self._stats[_module_args(data).get('path')] = data['stat']
+
     @property
     def stripe(self):
         return '{ip} connection={conn} ansible_ssh_user={user}'.format(
@@ -93,24 +253,73 @@ class Node(_BaseNode):
     Interface class for all type of OS Nodes
     '''
     OS_FAMILY = None
+    # the facts is_concrete_class() decides on, the concrete class is
+    # resolved once per distinct values of them
+    FACT_SIGNATURE = ('ansible_os_family', 'ansible_distribution',
+                      'ansible_distribution_major_version')
+    # (class, signature values) -> concrete class, see get_concrete_os()
+    _resolved = {}
+    # class -> registry in resolution order, see concrete_classes()
+    _ordered = {}
+    _resolved_generation = None
 
     def __init__(self, node_template_inst):
         node = node_template_inst
         super(Node, self).__init__(
             node.address, connection=node.connection,
             user=node.user, group=node.group)
+        # keep gathered facts so shared contexts don't need to re-run setup
+        self._facts = node.facts
+        self._fact_loader = node._fact_loader
+        self._stats = node.stats
+
+    @staticmethod
+    def _sync_registry():
+        if Node._resolved_generation != RegisterClasses.generation:
+            # classes were registered since, resolve everything again
+            Node._resolved.clear()
+            Node._ordered.clear()
+            Node._resolved_generation = RegisterClasses.generation
+
+    @classmethod
+    def concrete_classes(cls):
+        '''
+        :return: the registered OS classes in the order they are tried,
+            most specific (deepest in the class tree) first and then by
+            name
+        '''
+        Node._sync_registry()
+        try:
+            return Node._ordered[cls]
+        except KeyError:
+            pass
+        ordered = Node._ordered[cls] = sorted(
+            getattr(cls, 'registry', {}).values(),
+            key=lambda klass: (-len(klass.__mro__), klass.__name__))
+        return ordered
 
     @classmethod
     def get_concrete_os(cls, facts):
-        if hasattr(cls, 'registry'):
-            for _, klass in cls.registry.iteritems():
-                try:
-                    if klass.is_concrete_class(facts):
-                        cls = klass
-                        break
-                except:
-                    raise
-        return cls
+        '''
+        :return: the first of concrete_classes() whose is_concrete_class()
+            accepts facts, cls if none does
+        '''
+        Node._sync_registry()
+        # read the gathered data, lazily gathered facts aren't loaded
+        data = getattr(facts, '_data', facts)
+        key = (cls,) + tuple(data.get(name) for name in cls.FACT_SIGNATURE)
+        try:
+            return Node._resolved[key]
+        except KeyError:
+            pass
+
+        concrete = cls
+        for klass in cls.concrete_classes():
+            if klass.is_concrete_class(facts):
+                concrete = klass
+                break
+        Node._resolved[key] = concrete
+        return concrete
 
 
 class RedHat(with_metaclass(RegisterClasses, Node)):
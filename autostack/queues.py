@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import threading
+
+from uuid import uuid4
+from six.moves import queue
+
+
+BACKENDS = ('memory', 'redis')
+
+
+class MemoryQueue(object):
+    '''
+    In-process queue with the RedisQueue interface, items are handed over
+    as is without any serialization.
+
+    Only results produced by this process reach it, ansible results of
+    forked workers are published by the parent once the run is over
+    (see AnsibleRunnerCallback.publish).
+    '''
+    cross_process = False
+
+    def __init__(self, name=None):
+        self.__q = queue.Queue()
+        self.__key = name or str(uuid4())
+        self.__produced = 0
+        self.__lock = threading.Lock()
+
+    def __len__(self):
+        """Return the approximate size of the queue."""
+        return self.__q.qsize()
+
+    @property
+    def key(self):
+        return self.__key
+
+    def empty(self):
+        """Return True if the queue is empty, False otherwise."""
+        return self.__q.empty()
+
+    def clear(self):
+        # dropped items will never be applied, don't wait for them
+        while self.get(block=False) is not None:
+            with self.__lock:
+                self.__produced -= 1
+
+    def put(self, item):
+        """Put item into the queue."""
+        self.put_many([item])
+
+    def put_many(self, items):
+        """Put all items into the queue."""
+        with self.__lock:
+            self.__produced += len(items)
+        for item in items:
+            self.__q.put(item)
+
+    def produced(self):
+        """Return how many items were ever put into the queue."""
+        return self.__produced
+
+    def get(self, block=True, timeout=None):
+        """Remove and return an item from the queue, None if there is none.
+
+        If optional args block is true and timeout is None (the default), block
+        if necessary until an item is available."""
+        try:
+            return self.__q.get(block, timeout)
+        except queue.Empty:
+            return None
+
+    def get_batch(self, max_items=100, timeout=None):
+        """Remove and return a list of up to max_items items.
+
+        Block up to timeout seconds (forever if None, not at all if 0) for
+        the first item. An empty list means the timeout expired."""
+        item = self.get(block=timeout != 0, timeout=timeout or None)
+        if item is None:
+            return []
+        items = [item]
+        while len(items) < max_items:
+            item = self.get(block=False)
+            if item is None:
+                break
+            items.append(item)
+        return items
+
+    def join(self):
+        self.put('goodbye')
+
+
+def create_queue(backend='redis', **kwargs):
+    '''
+    :param backend: "memory" for in-process runs or "redis" to share the
+        queue between processes
+    :param kwargs: RedisQueue arguments, ignored by the memory backend
+    '''
+    if backend == 'memory':
+        return MemoryQueue(kwargs.get('name'))
+    if backend == 'redis':
+        # redis is only required by the redis backend
+        from autostack.redisq import RedisQueue
+        return RedisQueue(**kwargs)
+    raise ValueError('Unknown queue backend {!r}, choose one of {}'.format(
+        backend, BACKENDS))
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import json
+import fcntl
+import hashlib
+import functools
+import threading
+
+from autostack.errors import AnsibleNotRecorded
+
+
+class ResultStore(object):
+    '''
+    Append-only JSON lines file of ansible results, --autostack-record
+    writes it and --autostack-replay serves it instead of running ansible.
+
+    Every call is stored under a key made of what was run and against
+    which hosts, as the messages it put into the queue followed by what
+    the call returned:
+
+    {"key": "...", "message": {"host": "1.1.1.1", "result": {...}}}
+    {"key": "...", "return": {"contacted": {...}, "dark": {}}}
+
+    Forked ansible workers append their messages on their own, writes
+    are serialized with flock(). Repeated calls are replayed in the
+    order they were recorded, the last one is served from then on.
+    '''
+    def __init__(self, path, replay=False):
+        '''
+        :param path: the store file
+        :param replay: serve recorded results instead of recording
+        '''
+        self.path = os.path.abspath(os.path.expanduser(path))
+        self.replaying = replay
+        # key -> [(messages, returned)]
+        self._calls = {}
+        self._lock = threading.Lock()
+        if replay:
+            self._load()
+
+    @staticmethod
+    def key(kind, *parts):
+        '''
+        :param kind: "module", "playbook" or "batch"
+        :param parts: json serializable description of the call
+        '''
+        data = json.dumps([kind] + list(parts), sort_keys=True)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def _load(self):
+        pending = {}
+        with open(self.path, 'r') as f:
+            for line in f:
+                entry = json.loads(line)
+                messages = pending.setdefault(entry['key'], [])
+                if 'message' in entry:
+                    messages.append(entry['message'])
+                else:
+                    self._calls.setdefault(entry['key'], []).append(
+                        (pending.pop(entry['key']), entry['return']))
+
+    def _append(self, entries):
+        data = ''.join(json.dumps(entry, separators=(',', ':')) + '\n'
+                       for entry in entries)
+        with open(self.path, 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(data)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def recorder(self, key):
+        '''
+        :return: callable(items) recording queue messages of the call,
+            None while replaying
+        '''
+        if self.replaying:
+            return None
+        return functools.partial(self.record_messages, key)
+
+    def record_messages(self, key, items):
+        if items:
+            self._append({'key': key, 'message': item} for item in items)
+
+    def record_return(self, key, returned):
+        self._append([{'key': key, 'return': returned}])
+
+    def replay(self, key, queue):
+        '''
+        Put the recorded messages of the call into queue.
+
+        :return: what the call returned
+        :raise AnsibleNotRecorded: in case the call was never recorded
+        '''
+        with self._lock:
+            try:
+                calls = self._calls[key]
+            except KeyError:
+                raise AnsibleNotRecorded(
+                    'No recorded results in {} for call {}'.format(
+                        self.path, key))
+            messages, returned = calls.pop(0) if len(calls) > 1 else calls[0]
+        queue.put_many(messages)
+        return returned
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import os
+import sys
+import math
+import time
+import signal
+import socket
+import traceback
+import multiprocessing
+
+import ansible.runner
+import ansible.errors
+
+from ansible.runner.return_data import ReturnData
+from six.moves import queue as Queue
+
+
+def _executor_hook(runner, job_queue, result_queue, new_stdin):
+    '''
+    ansible.runner._executor_hook() with the runner passed explicitly
+    instead of read from the multiprocessing_runner module global.
+    '''
+    if ansible.runner.HAS_ATFORK:
+        ansible.runner.atfork()
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    runner._forked = True
+    while not job_queue.empty():
+        try:
+            host = job_queue.get(block=False)
+            if runner.host_timeout:
+                # lets the parent time the host and terminate this worker
+                result_queue.put((host, os.getpid()))
+            return_data = runner._executor(host, new_stdin)
+            if runner.has_timeouts:
+                # this worker may get terminated, don't keep results
+                # buffered in the callbacks
+                flush = getattr(runner.callbacks, 'flush', None)
+                if flush is not None:
+                    flush()
+            result_queue.put(return_data)
+        except Queue.Empty:
+            pass
+        except Exception:
+            traceback.print_exc()
+
+
+class Runner(ansible.runner.Runner):
+    '''
+    ansible Runner that is safe to run from several threads at once.
+
+    Runner.run() publishes itself in the multiprocessing_runner module
+    global which its forked workers read, two runners started from
+    different threads could fork workers of each other. Here every worker
+    gets its runner as an argument.
+
+    result_hook, if given, is called in the calling process with the
+    ReturnData of every host as soon as it is received.
+
+    Stragglers are cut off by:
+    - deadline: seconds the whole run may take
+    - host_timeout: seconds a single host may take
+    - quorum: stop once this many hosts (or this fraction of the hosts,
+      for 0 < quorum < 1) returned
+
+    Workers of stragglers are terminated and the hosts are reported
+    under results['timed_out'] instead of "contacted" or "dark". Serial
+    runs execute every host in a forked worker while a policy is set, so
+    it can be terminated as well.
+
+    _AnsibleModule returns the partial results of a quorum or deadline
+    run with the stragglers marked timed_out=True, hosts passing
+    host_timeout fail the call.
+    '''
+    # seconds between checks of the workers while no result arrives
+    RESULT_POLL = 0.1
+    # True in forked workers
+    _forked = False
+
+    def __init__(self, *args, **kwargs):
+        self.result_hook = kwargs.pop('result_hook', None)
+        self.deadline = kwargs.pop('deadline', None)
+        self.host_timeout = kwargs.pop('host_timeout', None)
+        self.quorum = kwargs.pop('quorum', None)
+        self.timed_out = set()
+        self._returned = 0
+        self._deadline_at = None
+        self._quorum = None
+        super(Runner, self).__init__(*args, **kwargs)
+
+    @property
+    def has_timeouts(self):
+        return bool(self.deadline or self.host_timeout or self.quorum)
+
+    def run(self):
+        if not self.run_hosts:
+            self.run_hosts = self.inventory.list_hosts(self.pattern)
+        self.timed_out = set()
+        self._returned = 0
+        self._deadline_at = time.time() + self.deadline \
+            if self.deadline else None
+        self._quorum = None
+        if self.quorum:
+            self._quorum = self.quorum if self.quorum >= 1 else \
+                int(math.ceil(self.quorum * len(self.run_hosts)))
+        return super(Runner, self).run()
+
+    def _notify(self, return_data):
+        self._returned += 1
+        if self.result_hook is not None:
+            self.result_hook(return_data)
+
+    def _cut_off(self):
+        if self._quorum is not None and self._returned >= self._quorum:
+            return True
+        return self._deadline_at is not None and \
+            time.time() >= self._deadline_at
+
+    def _executor(self, host, new_stdin):
+        if self._forked:
+            return super(Runner, self)._executor(host, new_stdin)
+
+        # serial run, forked workers are reported by _parallel_exec()
+        if self.has_timeouts:
+            results = [] if self._cut_off() else self._parallel_exec([host])
+            if not results:
+                self.timed_out.add(host)
+                return ReturnData(host=host, comm_ok=False,
+                                  result=dict(failed=True, timed_out=True))
+            return results[0]
+
+        return_data = super(Runner, self)._executor(host, new_stdin)
+        self._notify(return_data)
+        return return_data
+
+    def _start_worker(self, job_queue, result_queue, fileno):
+        new_stdin = None
+        if fileno is not None:
+            try:
+                new_stdin = os.fdopen(os.dup(fileno))
+            except OSError:
+                # not a valid file descriptor, rely on the one that
+                # was passed in
+                pass
+        prc = multiprocessing.Process(
+            target=_executor_hook,
+            args=(self, job_queue, result_queue, new_stdin))
+        prc.start()
+        return prc
+
+    def _expire(self, workers, running, job_queue, result_queue, fileno):
+        '''
+        Terminate workers of hosts which passed host_timeout and start
+        new workers for the hosts still waiting in job_queue.
+        '''
+        now = time.time()
+        for host, (pid, started) in list(running.items()):
+            if now - started < self.host_timeout:
+                continue
+            del running[host]
+            self.timed_out.add(host)
+            for worker in workers:
+                if worker.pid == pid:
+                    worker.terminate()
+                    worker.join()
+                    workers.remove(worker)
+                    if not job_queue.empty():
+                        workers.append(self._start_worker(
+                            job_queue, result_queue, fileno))
+                    break
+
+    def _parallel_exec(self, hosts):
+        manager = multiprocessing.Manager()
+        job_queue = manager.Queue()
+        for host in hosts:
+            job_queue.put(host)
+        result_queue = manager.Queue()
+
+        try:
+            fileno = sys.stdin.fileno()
+        except ValueError:
+            fileno = None
+
+        workers = [self._start_worker(job_queue, result_queue, fileno)
+                   for _ in range(self.forks)]
+
+        results = []
+        # host -> (worker pid, start time), when host_timeout is set
+        running = {}
+        finished = False
+        try:
+            # collect results while the workers run so result_hook sees
+            # every host as soon as it is done
+            while not self._cut_off():
+                try:
+                    item = result_queue.get(timeout=self.RESULT_POLL)
+                except Queue.Empty:
+                    item = None
+
+                if isinstance(item, tuple):
+                    running[item[0]] = (item[1], time.time())
+                elif item is not None:
+                    running.pop(item.host, None)
+                    results.append(item)
+                    self._notify(item)
+                    if len(results) == len(hosts):
+                        finished = True
+                        break
+                elif not any(worker.is_alive() for worker in workers) and \
+                        result_queue.empty():
+                    finished = True
+                    break
+
+                if self.host_timeout:
+                    self._expire(workers, running, job_queue, result_queue,
+                                 fileno)
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.terminate()
+        except socket.error:
+            raise ansible.errors.AnsibleError("<interrupted>")
+        finally:
+            for worker in workers:
+                if not finished and worker.is_alive():
+                    # stragglers of a deadline or quorum
+                    worker.terminate()
+                worker.join()
+            manager.shutdown()
+
+        if self.has_timeouts:
+            returned = set(return_data.host for return_data in results)
+            self.timed_out.update(host for host in hosts
+                                  if host not in returned)
+        return results
+
+    def _partition_results(self, results):
+        results2 = super(Runner, self)._partition_results(results)
+        if results2 is not None:
+            results2['timed_out'] = dict(
+                (host, dict(failed=True, timed_out=True,
+                            msg='Timed out, deadline={} host_timeout={} '
+                            'quorum={}'.format(self.deadline,
+                                               self.host_timeout,
+                                               self.quorum)))
+                for host in self.timed_out)
+            for host in self.timed_out:
+                results2['dark'].pop(host, None)
+                results2['contacted'].pop(host, None)
+        return results2
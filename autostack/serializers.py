@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import json
+import zlib
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class JSONCodec(object):
+    name = 'json'
+    tag = b'j'
+
+    @staticmethod
+    def dumps(obj):
+        data = json.dumps(obj, separators=(',', ':'))
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        return data
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data.decode('utf-8'))
+
+
+class MsgpackCodec(object):
+    name = 'msgpack'
+    tag = b'm'
+
+    @staticmethod
+    def dumps(obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    @staticmethod
+    def loads(data):
+        return msgpack.unpackb(data, raw=False)
+
+
+class PickleCodec(object):
+    '''
+    Fastest and keeps python types, but only use it when every producer
+    of the queue is trusted, unpickling can execute arbitrary code.
+    '''
+    name = 'pickle'
+    tag = b'p'
+
+    @staticmethod
+    def dumps(obj):
+        return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(data):
+        return pickle.loads(data)
+
+
+CODECS = dict((codec.name, codec) for codec in (JSONCodec, PickleCodec))
+if msgpack is not None:
+    CODECS[MsgpackCodec.name] = MsgpackCodec
+
+# name -> (tag, compress, decompress)
+COMPRESSIONS = {'none': (b'-', None, None),
+                'zlib': (b'z', zlib.compress, zlib.decompress)}
+if lz4 is not None:
+    COMPRESSIONS['lz4'] = (b'4', lz4.frame.compress, lz4.frame.decompress)
+
+
+class Serializer(object):
+    '''
+    Turns queue items into bytes and back.
+
+    Every message starts with a codec tag and a compression tag. Readers
+    decompress whatever compression was used but only decode messages of
+    their own codec, a json queue never unpickles what was pushed to it.
+    Messages smaller than threshold bytes are never compressed.
+
+    >>> s = Serializer('msgpack', compression='zlib', threshold=4096)
+    >>> s.loads(s.dumps({'host': '1.1.1.1', 'result': {...}}))
+    '''
+    def __init__(self, codec='json', compression='none', threshold=4096):
+        try:
+            self.codec = CODECS[codec]
+        except KeyError:
+            raise ValueError('Unknown or unavailable codec {!r}, '
+                             'choose one of {}'.format(codec, sorted(CODECS)))
+        try:
+            self._compression = COMPRESSIONS[compression or 'none']
+        except KeyError:
+            raise ValueError('Unknown or unavailable compression {!r}, '
+                             'choose one of {}'.format(compression,
+                                                       sorted(COMPRESSIONS)))
+        self.threshold = threshold
+
+    def dumps(self, obj):
+        data = self.codec.dumps(obj)
+        tag, compress, _ = self._compression
+        if compress is None or len(data) < self.threshold:
+            tag = COMPRESSIONS['none'][0]
+        else:
+            data = compress(data)
+        return self.codec.tag + tag + data
+
+    def loads(self, data):
+        '''
+        :raise ValueError: in case data wasn't encoded with this codec
+        '''
+        codec_tag, compression_tag, data = data[:1], data[1:2], data[2:]
+        if codec_tag != self.codec.tag:
+            raise ValueError('Refusing codec tag {!r}, expected {!r} '
+                             '({})'.format(codec_tag, self.codec.tag,
+                                           self.codec.name))
+        for tag, _, decompress in COMPRESSIONS.values():
+            if tag == compression_tag:
+                if decompress is not None:
+                    data = decompress(data)
+                break
+        else:
+            raise ValueError('Unknown compression tag {!r}'.format(
+                compression_tag))
+        return self.codec.loads(data)
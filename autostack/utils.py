@@ -9,12 +9,45 @@ __author__ = 'Avi Tal <avi3tal@gmail.com>'
 __date__ = 'Sep 8, 2015'
 
 
-class RegisterClasses(type):
+class RegisterHandlers(type):
+    '''
+    Every _load_<module> method of a node class handles the results of
+    <module>. The handlers of each class, inherited ones included, are
+    collected into RegisterHandlers.table when the class is defined, so
+    routing a result is a single lookup:
+
+    >>> RegisterHandlers.table[(type(node), 'setup')](node, result)
+    '''
+    PREFIX = '_load_'
+    # (node class, module name) -> handler function
+    table = {}
+
+    def __init__(cls, name, bases, dct):
+        super(RegisterHandlers, cls).__init__(name, bases, dct)
+        handlers = {}
+        for klass in reversed(cls.__mro__):
+            for attr, value in vars(klass).items():
+                if attr.startswith(cls.PREFIX) and callable(value):
+                    handlers[attr[len(cls.PREFIX):]] = value
+        for module_name, handler in handlers.items():
+            RegisterHandlers.table[(cls, module_name)] = handler
+
+
+class RegisterClasses(RegisterHandlers):
+    '''
+    Subclasses of the class defined with this metaclass are registered
+    by their lower cased name in its registry.
+    '''
+    # bumped by every registration, lets users cache what they derive
+    # from the registries
+    generation = 0
+
     def __init__(cls, name, bases, dct):
         if not hasattr(cls, 'registry'):
             cls.registry = {}
         else:
             cls.registry[name.lower()] = cls
+            RegisterClasses.generation += 1
         super(RegisterClasses, cls).__init__(name, bases, dct)
 
 
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Micro benchmark of Compound set algebra, the hash based operators against
+the list scan that Compound.__sub__ used to do.
+
+    $ PYTHONPATH=. python benchmarks/bench_compound.py
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import timeit
+
+from autostack.environment import Compound
+from autostack.nodes import NodeTemplate
+
+
+def list_sub(left, right):
+    return Compound([item for item in left if item not in right])
+
+
+def list_and(left, right):
+    return Compound([item for item in left if item in right])
+
+
+def main():
+    for size in (100, 500, 1000):
+        nodes = Compound([NodeTemplate('10.0.{}.{}'.format(i // 256, i % 256))
+                          for i in range(size)])
+        failed = Compound(nodes[::3])
+        number = max(10, 100000 // size)
+        for name, old, new in (('-', list_sub, lambda a, b: a - b),
+                               ('&', list_and, lambda a, b: a & b)):
+            scan = timeit.timeit(lambda: old(nodes, failed), number=number)
+            hashed = timeit.timeit(lambda: new(nodes, failed), number=number)
+            print('{:>5} nodes {}: scan {:10.2f}us  hash {:8.2f}us  '
+                  'x{:.0f}'.format(size, name, scan / number * 1e6,
+                                   hashed / number * 1e6, scan / hashed))
+
+
+if __name__ == '__main__':
+    main()
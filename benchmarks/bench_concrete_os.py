@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Micro benchmark of Context.set_concrete_os, the concrete OS class memoized
+per fact signature against walking the registry and running every
+is_concrete_class predicate for each node (the previous implementation).
+
+    $ PYTHONPATH=. python benchmarks/bench_concrete_os.py
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import timeit
+
+from autostack.environment import Context
+from autostack.nodes import NodeTemplate, RedHat, CentOS
+
+
+DISTROS = 40
+SIGNATURES = 8
+
+
+def build_tree():
+    for i in range(DISTROS):
+        name = str('Distro{}'.format(i))
+
+        def is_concrete_class(cls, facts, name=name):
+            return facts.distribution == name
+        type(name, (CentOS,),
+             {'is_concrete_class': classmethod(is_concrete_class)})
+
+
+def walk(cls, facts):
+    for _, klass in cls.registry.iteritems():
+        if klass.is_concrete_class(facts):
+            return klass
+    return cls
+
+
+def walk_concrete_class(node):
+    klass = NodeTemplate.KLASS_REF[node.facts.os_family.lower()]
+    return walk(klass, node.facts)(node)
+
+
+def build_context(size, groups=10):
+    ctx = Context()
+    for group in range(groups):
+        name = 'group{}'.format(group)
+        nodes = []
+        for i in range(size // groups):
+            node = NodeTemplate('10.{}.{}.{}'.format(group, i // 256,
+                                                     i % 256), group=name)
+            node._load_setup({'ansible_facts': {
+                'ansible_os_family': 'RedHat',
+                'ansible_distribution': 'Distro{}'.format(
+                    DISTROS - 1 - i % SIGNATURES),
+                'ansible_distribution_major_version': '7'}})
+            nodes.append(node)
+        ctx[name] = nodes
+    return ctx
+
+
+def main():
+    build_tree()
+    for size in (1000, 10000):
+        ctx = build_context(size)
+        nodes = list(ctx.all)
+        number = 10 if size < 10000 else 3
+        for name, old, new in (
+                ('resolve', lambda node: walk(RedHat, node.facts),
+                 lambda node: RedHat.get_concrete_os(node.facts)),
+                ('resolve+init', walk_concrete_class,
+                 lambda node: node.get_concrete_class())):
+            walked = timeit.timeit(lambda: [old(node) for node in nodes],
+                                   number=number)
+            cached = timeit.timeit(lambda: [new(node) for node in nodes],
+                                   number=number)
+            print('{:>6} nodes {:>12}: walk {:8.2f}ms  memoized {:8.2f}ms  '
+                  'x{:.0f}'.format(size, name, walked / number * 1e3,
+                                   cached / number * 1e3, walked / cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Micro benchmark of Context.all, the memoized property against rebuilding
+the set of all nodes on every access (the previous implementation).
+
+    $ PYTHONPATH=. python benchmarks/bench_context.py
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import timeit
+
+from autostack.environment import Context, Compound
+from autostack.nodes import NodeTemplate
+
+
+def rebuild_all(ctx):
+    all_set = set()
+    for _, hosts in ctx.iteritems():
+        all_set |= set(hosts)
+    return Compound(all_set)
+
+
+def build_context(size, groups=10):
+    ctx = Context()
+    for group in range(groups):
+        name = 'group{}'.format(group)
+        ctx[name] = [NodeTemplate('10.{}.{}.{}'.format(group, i // 256,
+                                                       i % 256), group=name)
+                     for i in range(size // groups)]
+    return ctx
+
+
+def main():
+    for size in (1000, 10000):
+        ctx = build_context(size)
+        number = 1000 if size < 10000 else 100
+        rebuilt = timeit.timeit(lambda: rebuild_all(ctx), number=number)
+        ctx.all  # warm up the cache
+        cached = timeit.timeit(lambda: ctx.all, number=number)
+        print('{:>6} nodes: rebuild {:10.2f}us  cached {:8.2f}us  '
+              'x{:.0f}'.format(size, rebuilt / number * 1e6,
+                               cached / number * 1e6, rebuilt / cached))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Encode/decode throughput of the queue serializers on a setup result,
+compared to the repr()/eval() round trip RedisQueue used to do.
+
+    $ PYTHONPATH=. python benchmarks/bench_serializers.py
+'''
+from __future__ import (absolute_import, division, print_function,
+                        unicode_literals)
+
+import timeit
+
+from autostack.serializers import Serializer, CODECS, COMPRESSIONS
+
+
+def setup_result(interfaces=8, mounts=20, env=40):
+    '''A setup result of roughly the size a CentOS 7 host returns.'''
+    facts = {
+        'ansible_os_family': 'RedHat',
+        'ansible_distribution': 'CentOS',
+        'ansible_distribution_major_version': '7',
+        'ansible_distribution_version': '7.1.1503',
+        'ansible_hostname': 'node01',
+        'ansible_processor': ['GenuineIntel',
+                              'Intel(R) Xeon(R) CPU E5-2680 v2'] * 16,
+        'ansible_env': dict(('VAR_{}'.format(i), '/usr/local/bin:' * 4)
+                            for i in range(env)),
+        'ansible_mounts': [{'device': '/dev/sda{}'.format(i),
+                            'fstype': 'xfs',
+                            'mount': '/mnt/data{}'.format(i),
+                            'options': 'rw,seclabel,relatime,attr2',
+                            'size_available': 51836555264 + i,
+                            'size_total': 53660876800}
+                           for i in range(mounts)],
+        'ansible_interfaces': ['eth{}'.format(i) for i in range(interfaces)],
+    }
+    for i in range(interfaces):
+        facts['ansible_eth{}'.format(i)] = {
+            'active': True,
+            'device': 'eth{}'.format(i),
+            'ipv4': {'address': '10.0.{}.1'.format(i),
+                     'netmask': '255.255.255.0',
+                     'network': '10.0.{}.0'.format(i)},
+            'ipv6': [{'address': 'fe80::250:56ff:fe8a:{:x}'.format(i),
+                      'prefix': '64', 'scope': 'link'}],
+            'macaddress': '00:50:56:8a:00:{:02x}'.format(i),
+            'module': 'vmxnet3', 'mtu': 1500, 'promisc': False,
+            'type': 'ether'}
+    return {'host': '10.0.0.1',
+            'result': {'ansible_facts': facts, 'changed': False,
+                       'invocation': {'module_args': '',
+                                      'module_name': 'setup'}}}
+
+
+def measure(dumps, loads, item, number):
+    data = dumps(item)
+    encode = timeit.timeit(lambda: dumps(item), number=number) / number
+    decode = timeit.timeit(lambda: loads(data), number=number) / number
+    return len(data), encode * 1e6, decode * 1e6, 1 / (encode + decode)
+
+
+def main(number=200):
+    item = setup_result()
+    rows = [('repr/eval', ) +
+            measure(lambda obj: str(obj).encode('utf-8'),
+                    lambda data: eval(data), item, number)]
+    for codec in sorted(CODECS):
+        for compression in sorted(COMPRESSIONS):
+            serializer = Serializer(codec, compression, threshold=0)
+            rows.append(('{}+{}'.format(codec, compression), ) +
+                        measure(serializer.dumps, serializer.loads,
+                                item, number))
+
+    print('{:<16} {:>8} {:>10} {:>10} {:>12}'.format(
+        'serializer', 'bytes', 'encode us', 'decode us', 'roundtrip/s'))
+    for row in rows:
+        print('{:<16} {:>8} {:>10.1f} {:>10.1f} {:>12.0f}'.format(*row))
+
+
+if __name__ == '__main__':
+    main()
@@ -19,6 +19,10 @@ setup(
     },
     zip_safe=False,
     install_requires=['ansible', 'pytest>=2.4.2', 'py>=1.4.22', 'redis', 'six'],
+    extras_require={
+        'msgpack': ['msgpack>=0.5.2'],
+        'lz4': ['lz4'],
+    },
     setup_requires=['setuptools_scm'],
     classifiers=[
         'Private :: Do Not Upload',
@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import sys
+import time
+import multiprocessing
+
+import pytest
+
+from six.moves.queue import Empty
+
+from autostack.actions import (AnsibleRunnerCallback, _AnsibleModule,
+                               clear_inventory_cache, gather, resolve_forks,
+                               forks_used)
+from autostack.environment import Compound, Context
+from autostack.errors import AnsibleCompoundException, AnsibleNotRecorded
+from autostack.nodes import NodeTemplate
+from autostack.queues import MemoryQueue
+from autostack.recorder import ResultStore
+from autostack.memo import ResultMemo
+from autostack.factcache import FactCache
+
+
+class ListQueue(object):
+    cross_process = True
+
+    def __init__(self):
+        self.batches = multiprocessing.Queue()
+
+    def put_many(self, items):
+        if items:
+            self.batches.put(items)
+
+    def drain(self):
+        batches = []
+        while True:
+            try:
+                batches.append(self.batches.get(timeout=0.5))
+            except Empty:
+                return batches
+
+
+def test_callback_buffers_by_size():
+    queue = ListQueue()
+    callback = AnsibleRunnerCallback(queue, flush_size=3, flush_interval=60)
+    for i in range(7):
+        callback.on_ok('1.1.1.{}'.format(i), {'rc': 0})
+    callback.flush()
+    assert [len(batch) for batch in queue.drain()] == [3, 3, 1]
+
+
+def test_callback_flushes_forked_workers():
+    queue = ListQueue()
+    callback = AnsibleRunnerCallback(queue, flush_size=10, flush_interval=60)
+
+    def worker():
+        callback.on_ok('1.1.1.1', {'rc': 0})
+        callback.on_ok('1.1.1.2', {'rc': 0})
+
+    process = multiprocessing.Process(target=worker)
+    process.start()
+    process.join()
+    assert [[msg['host'] for msg in batch] for batch in queue.drain()] == [
+        ['1.1.1.1', '1.1.1.2']]
+
+
+def test_callback_publishes_to_memory_queue():
+    queue = MemoryQueue()
+    callback = AnsibleRunnerCallback(queue)
+    callback.on_ok('1.1.1.1', {'rc': 0})
+
+    def worker():
+        callback.on_ok('1.1.1.2', {'rc': 0})
+
+    process = multiprocessing.Process(target=worker)
+    process.start()
+    process.join()
+    callback.publish({'contacted': {'1.1.1.1': {'rc': 0},
+                                    '1.1.1.2': {'rc': 0},
+                                    '1.1.1.3': {'rc': 1}},
+                      'dark': {'1.1.1.4': {}}})
+    assert sorted(msg['host'] for msg in queue.get_batch(timeout=0)) == [
+        '1.1.1.1', '1.1.1.2']
+
+
+def test_inventory_in_memory():
+    nodes = [NodeTemplate('1.1.1.1', group='clients'),
+             NodeTemplate('2.2.2.2', group='servers', connection='local',
+                          user='avi')]
+    inventory = _AnsibleModule._ansible_inventory(nodes)
+    assert sorted(inventory.list_hosts('all')) == ['1.1.1.1', '2.2.2.2']
+    assert inventory.list_hosts('servers') == ['2.2.2.2']
+    assert inventory.get_variables('2.2.2.2')['ansible_ssh_user'] == 'avi'
+    assert inventory.get_variables('2.2.2.2')['connection'] == 'local'
+
+    inventory.restrict_to(['1.1.1.1'])
+    again = _AnsibleModule._ansible_inventory(list(reversed(nodes)))
+    assert again is inventory
+    assert sorted(again.list_hosts('all')) == ['1.1.1.1', '2.2.2.2']
+
+    nodes[1].user = 'root'
+    assert _AnsibleModule._ansible_inventory(nodes) is not inventory
+    assert _AnsibleModule._ansible_inventory(nodes, cache=False) is not \
+        _AnsibleModule._ansible_inventory(nodes)
+    clear_inventory_cache()
+
+
+def _local_nodes(*addresses, **host_vars):
+    nodes = Compound([NodeTemplate(address, connection='local')
+                      for address in addresses])
+    # module calls reuse the cached inventory, run them with this python
+    inventory = _AnsibleModule._ansible_inventory(nodes)
+    for host in inventory.get_hosts('all'):
+        host.set_variable('ansible_python_interpreter', sys.executable)
+        for key, values in host_vars.items():
+            host.set_variable(key, values[host.name])
+    return nodes
+
+
+def test_submit_overlaps_calls():
+    queue = MemoryQueue()
+    run = _AnsibleModule(queue, connection='local')
+    first = _local_nodes('127.0.0.1', '127.0.0.2')
+    second = _local_nodes('127.0.0.3')
+
+    started = time.time()
+    calls = [run.command.submit(first, 'sleep 1', forks=2),
+             run.command.submit(second, 'sleep 1')]
+    results = gather(*calls, timeout=30)
+    assert time.time() - started < 1.9
+    assert sorted(results[0]) == ['127.0.0.1', '127.0.0.2']
+    assert list(results[1]) == ['127.0.0.3']
+    assert len(queue) == 3
+
+    failed = run.command.submit(second, 'false')
+    with pytest.raises(AnsibleCompoundException):
+        gather(failed, timeout=30)
+    clear_inventory_cache()
+
+
+def test_stream_results():
+    queue = MemoryQueue()
+    run = _AnsibleModule(queue, connection='local')
+    nodes = _local_nodes('127.0.0.1', '127.0.0.2', '127.0.0.3',
+                         delay={'127.0.0.1': 0, '127.0.0.2': 0.5,
+                                '127.0.0.3': 1.5},
+                         code={'127.0.0.1': 0, '127.0.0.2': 1,
+                               '127.0.0.3': 0})
+
+    started = time.time()
+    results = run.shell(nodes, 'sleep {{ delay }}; exit {{ code }}',
+                        forks=3, stream=True)
+    host, res = next(results)
+    assert host == '127.0.0.1' and res['rc'] == 0
+    assert time.time() - started < 1.5
+    with pytest.raises(AnsibleCompoundException) as err:
+        next(results)
+    assert list(err.value.contacted) == ['127.0.0.2']
+    assert [name for name, _ in results] == ['127.0.0.3']
+    assert sorted(results.contacted) == ['127.0.0.1', '127.0.0.2',
+                                         '127.0.0.3']
+    assert list(results) == []
+    clear_inventory_cache()
+
+
+def test_straggler_policies():
+    run = _AnsibleModule(MemoryQueue(), connection='local')
+    nodes = _local_nodes('127.0.0.1', '127.0.0.2', '127.0.0.3',
+                         delay={'127.0.0.1': 0, '127.0.0.2': 0,
+                                '127.0.0.3': 10})
+
+    started = time.time()
+    with pytest.raises(AnsibleCompoundException) as err:
+        run.shell(nodes, 'sleep {{ delay }}', forks=3, host_timeout=1)
+    assert list(err.value.timed_out) == ['127.0.0.3']
+    assert sorted(err.value.contacted) == ['127.0.0.1', '127.0.0.2']
+
+    res = run.shell(nodes, 'sleep {{ delay }}', forks=3, quorum=2)
+    assert res['127.0.0.1']['rc'] == 0
+    assert res['127.0.0.3']['timed_out']
+
+    # serial runs are cut off too
+    res = run.shell(nodes, 'sleep {{ delay }}', forks=1, deadline=1.5)
+    assert res['127.0.0.2']['rc'] == 0
+    assert res['127.0.0.3']['timed_out']
+    assert time.time() - started < 8
+    clear_inventory_cache()
+
+
+def test_resolve_forks(monkeypatch):
+    monkeypatch.setattr(multiprocessing, 'cpu_count', lambda: 2)
+    assert resolve_forks('auto', 3) == 3
+    assert resolve_forks('auto', 300) == 16
+    assert resolve_forks('auto', 300, cap=10) == 10
+    assert resolve_forks('auto', 0) == 1
+    assert resolve_forks('7', 300) == 7
+
+
+def test_batch():
+    queue = MemoryQueue()
+    run = _AnsibleModule(queue, connection='local')
+    nodes = _local_nodes('127.0.0.1', '127.0.0.2',
+                         code={'127.0.0.1': 0, '127.0.0.2': 3})
+
+    with run.batch(nodes) as batch:
+        ping = batch.ping()
+        echo = batch.shell('echo {{ inventory_hostname }}')
+    assert sorted(ping.results) == ['127.0.0.1', '127.0.0.2']
+    assert echo.results['127.0.0.2']['stdout'] == '127.0.0.2'
+    assert batch.results == [ping.results, echo.results]
+    # both modules of both hosts reached the queue
+    assert len(queue) == 4
+
+    with pytest.raises(AnsibleCompoundException) as err:
+        with run.batch(nodes) as batch:
+            batch.shell('exit {{ code }}')
+            uname = batch.command('uname')
+    assert list(err.value.contacted) == ['127.0.0.2']
+    assert uname.results['127.0.0.2']['rc'] == 0
+    clear_inventory_cache()
+
+
+def test_record_replay(tmpdir):
+    path = str(tmpdir.join('results.jsonl'))
+    queue = MemoryQueue()
+    run = _AnsibleModule(queue, connection='local',
+                         store=ResultStore(path))
+    nodes = _local_nodes('127.0.0.1', '127.0.0.2')
+    recorded = run.shell(nodes, 'echo {{ inventory_hostname }}', forks=2)
+    with run.batch(nodes) as batch:
+        batch.ping()
+    messages = queue.get_batch(10, timeout=0)
+    assert len(messages) == 4
+    clear_inventory_cache()
+
+    # nothing would run without the interpreter set by _local_nodes()
+    queue = MemoryQueue()
+    run = _AnsibleModule(queue, connection='local',
+                         store=ResultStore(path, replay=True))
+    nodes = Compound([NodeTemplate(node.address, connection='local')
+                      for node in nodes])
+    replayed = run.shell(nodes, 'echo {{ inventory_hostname }}')
+    assert replayed == recorded
+    with run.batch(nodes) as batch:
+        ping = batch.ping()
+    assert sorted(ping.results) == ['127.0.0.1', '127.0.0.2']
+    assert sorted(queue.get_batch(10, timeout=0)) == sorted(messages)
+
+    with pytest.raises(AnsibleNotRecorded):
+        run.shell(nodes, 'echo never recorded')
+    clear_inventory_cache()
+
+
+def test_memoize():
+    queue = MemoryQueue()
+    memo = ResultMemo(size=2, ttl=60, modules=['shell'])
+    run = _AnsibleModule(queue, connection='local', memo=memo)
+    nodes = _local_nodes('127.0.0.1', '127.0.0.2')
+    one = _local_nodes('127.0.0.1')
+
+    forks_used.clear()
+    first = run.shell(one, 'date +%s%N')
+    again = run.shell(nodes, 'date +%s%N')
+    assert again['127.0.0.1'] == first['127.0.0.1']
+    # sized for the hosts which ran, served calls don't count
+    assert run.shell(one, 'date +%s%N') == first
+    assert forks_used == {1: 2}
+    assert (memo.hits, memo.misses) == (2, 2)
+    # hits are applied to the context model again
+    assert len(queue) == 4
+
+    assert run.shell(one, 'date +%s%N', cache=False) != first
+    assert run.shell(one, 'date +%s%N', cache=0) != first
+    assert run.shell(one, 'date +%s%N', cache=0.001) != first
+    # least recently used entries were dropped
+    memo.set('ping', '', {}, {'127.0.0.3': {}})
+    assert list(memo.get('shell', 'date +%s%N', {},
+                         ['127.0.0.1', '127.0.0.2'], ttl=60)) == ['127.0.0.1']
+    clear_inventory_cache()
+
+
+def test_lazy_facts():
+    queue = MemoryQueue()
+    run = _AnsibleModule(queue, connection='local', facts='lazy')
+    nodes = _local_nodes('127.0.0.1', '127.0.0.2')
+    # single node loads run against this inventory
+    _local_nodes('127.0.0.1')
+    ctx = Context(hosts=nodes)
+
+    run.setup_context(ctx)
+    facts = ctx.all.facts
+    assert all(key.startswith(('ansible_os_family', 'ansible_distribution'))
+               for key in facts[0])
+    assert len(queue) == 2
+
+    # one call for the whole Compound, then plain reads
+    versions = facts.python_version
+    assert len(queue) == 4
+    assert versions[0] == versions[1]
+    assert ctx.all[1].facts.python_version == versions[1]
+    # Facts methods aren't loaded as facts
+    assert ctx.all.facts.keys()[0] == facts[0].keys()
+    assert len(queue) == 4
+    hostnames = ctx.all.filter(facts__hostname=lambda name: True)
+    assert hostnames == ctx.all
+    assert len(queue) == 6
+    with pytest.raises(KeyError):
+        ctx.all[0].facts.no_such_fact
+    with pytest.raises(KeyError):
+        ctx.all[0].facts.no_such_fact
+    assert len(queue) == 7
+    clear_inventory_cache()
+
+
+def test_setup_context_refresh(tmpdir):
+    cache = FactCache(str(tmpdir))
+    run = _AnsibleModule(MemoryQueue(), connection='local', fact_cache=cache)
+    node = _local_nodes('127.0.0.1')[0]
+    cache.set(node, {'ansible_os_family': 'Cached'})
+
+    run.setup_context(Context(hosts=[node]))
+    assert node.facts.os_family == 'Cached'
+    # clear=True and stale facts are gathered again
+    run.setup_context(Context(hosts=[node]), refresh=True)
+    assert node.facts.os_family != 'Cached'
+    assert cache.get(node) == node.facts
+    clear_inventory_cache()
@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import pytest
+
+from autostack import environment
+from autostack.environment import Context, Compound, initialize_context
+from autostack.nodes import NodeTemplate, CentOS7
+
+
+CENTOS7 = {'ansible_facts': {'ansible_os_family': 'RedHat',
+                             'ansible_distribution': 'CentOS',
+                             'ansible_distribution_major_version': '7'}}
+
+
+def _model():
+    model = Context()
+    model['hosts'] = [NodeTemplate('1.1.1.{}'.format(i), group='hosts')
+                      for i in range(3)]
+    model['local'] = [NodeTemplate('127.0.0.1', group='local')]
+    return model
+
+
+def test_by_address():
+    model = _model()
+    assert model.by_address('1.1.1.1') is model.hosts[1]
+    assert model.by_address('127.0.0.1') is model.local[0]
+    with pytest.raises(KeyError):
+        model.by_address('2.2.2.2')
+
+
+def test_by_address_follows_groups():
+    model = _model()
+    model['test'] = [NodeTemplate('2.2.2.2', group='test')]
+    assert model.by_address('2.2.2.2').group == 'test'
+    del model['test']
+    with pytest.raises(KeyError):
+        model.by_address('2.2.2.2')
+
+    model['local'] = [NodeTemplate('127.0.0.2', group='local')]
+    with pytest.raises(KeyError):
+        model.by_address('127.0.0.1')
+    assert model.by_address('127.0.0.2') is model.local[0]
+
+
+def test_by_address_follows_inplace_changes():
+    model = _model()
+    node = NodeTemplate('1.1.1.3', group='hosts')
+    model.hosts.append(node)
+    assert model.by_address('1.1.1.3') is node
+
+    model.local.pop()
+    with pytest.raises(KeyError):
+        model.by_address('127.0.0.1')
+
+
+def test_by_address_after_set_concrete_os():
+    model = _model()
+    model.hosts.append(NodeTemplate('1.1.1.3', group='hosts'))
+    assert model.by_address('1.1.1.2') is model.hosts[2]
+    for node in model.hosts:
+        node._load_setup(CENTOS7)
+    model.set_concrete_os()
+    node = model.by_address('1.1.1.0')
+    assert isinstance(node, CentOS7)
+    assert node is model.hosts[0]
+    assert node.facts.distribution == 'CentOS'
+    assert model.by_address('1.1.1.2') is model.hosts[2]
+    assert model.by_address('1.1.1.3') is model.hosts[3]
+    assert isinstance(model.by_address('127.0.0.1'), NodeTemplate)
+
+
+def test_all_is_deterministic():
+    model = _model()
+    model['containers'] = [NodeTemplate('2.2.2.1', group='containers')]
+    assert [node.address for node in model.all] == [
+        '2.2.2.1', '1.1.1.0', '1.1.1.1', '1.1.1.2', '127.0.0.1']
+    assert model.all[0] is model.containers[0]
+
+
+def test_all_is_cached_until_changed():
+    model = _model()
+    nodes = model.all
+    assert model.all is nodes
+
+    model.hosts.append(NodeTemplate('1.1.1.3', group='hosts'))
+    assert model.all is not nodes
+    assert len(model.all) == 5
+
+    nodes = model.all
+    del model['local']
+    assert model.all is not nodes
+    assert len(model.all) == 4
+
+
+def test_all_after_deleting_a_group():
+    model = Context(a=[], b=[])
+    model.a.append(NodeTemplate('1.1.1.1'))
+    model.a.append(NodeTemplate('1.1.1.2'))
+    assert len(model.all) == 2
+    del model['a']
+    node = NodeTemplate('2.2.2.2')
+    model.b.append(node)
+    assert model.all == [node]
+
+
+def test_all_after_set_concrete_os():
+    model = _model()
+    model.hosts.append(NodeTemplate('1.1.1.3', group='hosts'))
+    assert len(model.all) == 5
+    for node in model.hosts:
+        node._load_setup(CENTOS7)
+    model.set_concrete_os()
+    assert [type(node) for node in model.all[:4]] == [CentOS7] * 4
+
+
+def _nodes(count):
+    nodes = Compound()
+    for i in range(count):
+        node = NodeTemplate('10.0.0.{}'.format(i),
+                            group='even' if i % 2 else 'odd')
+        node._load_setup({'ansible_facts': {
+            'ansible_os_family': 'RedHat' if i % 3 else 'Debian',
+            'ansible_distribution_major_version': str(i % 4)}})
+        list.append(nodes, node)
+    return nodes
+
+
+@pytest.mark.parametrize('count', [10, 100])
+def test_filter(count):
+    nodes = _nodes(count)
+    expected = [n for n in nodes
+                if n.group == 'odd' and n.facts.os_family == 'Debian']
+    assert nodes.filter(group='odd', facts__os_family='Debian') == expected
+
+    expected = [n for n in nodes
+                if n.facts.distribution_major_version in ('1', '2')]
+    assert nodes.filter(
+        facts__distribution_major_version__in=['1', '2']) == expected
+
+    expected = [n for n in nodes if n.address != '10.0.0.1']
+    assert nodes.filter(address__ne='10.0.0.1') == expected
+
+    expected = [n for n in nodes if n.address.endswith('1')]
+    assert nodes.filter(address=lambda ip: ip.endswith('1')) == expected
+
+    expected = [n for n in nodes
+                if n.address == '10.0.0.1' or n.facts.os_family == 'Debian']
+    assert nodes.filter({'address': '10.0.0.1'},
+                        {'facts__os_family': 'Debian'}) == expected
+
+    assert nodes.filter(facts__missing='x') == []
+    assert nodes.filter(no_such_attr='x') == []
+
+
+def test_filter_index_invalidation():
+    nodes = _nodes(100)
+    assert len(nodes.filter(facts__os_family='Suse')) == 0
+    nodes[0]._load_setup({'ansible_facts': {'ansible_os_family': 'Suse'}})
+    assert nodes.filter(facts__os_family='Suse') == [nodes[0]]
+
+    node = NodeTemplate('10.0.1.1', group='odd')
+    nodes.append(node)
+    assert nodes.filter(address='10.0.1.1') == [node]
+
+
+@pytest.mark.parametrize('count', [10, 100])
+def test_filter_after_attribute_change(count):
+    model = Context(hosts=_nodes(count))
+    assert len(model.all.filter(user='root')) == count
+    model.all.user = 'admin'
+    assert len(model.all.filter(user='admin')) == count
+    assert model.all.filter(user='root') == []
+
+    assert len(model.all.filter(group__in=['odd', 'even'])) == count
+    with pytest.raises(TypeError):
+        model.all.filter(group__in='odd')
+
+
+def test_set_algebra():
+    nodes = _nodes(6)
+    left, right = Compound(nodes[:4]), Compound(nodes[2:])
+    assert left - right == nodes[:2]
+    assert left & right == nodes[2:4]
+    assert left | right == nodes
+    assert left ^ right == nodes[:2] + nodes[4:]
+    assert isinstance(left - right, Compound)
+    assert (left - right).address == ['10.0.0.0', '10.0.0.1']
+    assert list(nodes[:2]) | right == nodes[:2] + nodes[2:]
+
+    # unhashable items fall back to equality
+    facts = Compound([{'a': 1}, {'b': 2}])
+    assert facts - [{'a': 1}] == [{'b': 2}]
+    assert facts | [{'a': 1}, {'c': 3}] == [{'a': 1}, {'b': 2}, {'c': 3}]
+
+
+def test_inplace_set_algebra():
+    nodes = _nodes(6)
+    compound = Compound(nodes[:4])
+    version = compound._version
+    compound -= nodes[:1]
+    compound |= nodes[4:]
+    compound &= nodes[1:5]
+    compound ^= nodes[:2]
+    assert compound == [nodes[2], nodes[3], nodes[4], nodes[0]]
+    assert compound._version > version
+
+
+class _Request(object):
+    def __init__(self, inventory):
+        self.config = self
+        self.inventory = inventory
+
+    def getvalue(self, name):
+        return getattr(self, name)
+
+
+def test_initialize_context_parses_once(tmpdir, monkeypatch):
+    inventory = tmpdir.join('inventory')
+    inventory.write('default: dev\n'
+                    'dev:\n  hosts:\n  - address: 1.1.1.1\n'
+                    'prod:\n  hosts:\n  - address: 3.3.3.3\n')
+    request = _Request(str(inventory))
+    loads = []
+    load = environment.yaml.load
+    monkeypatch.setattr(environment.yaml, 'load',
+                        lambda *a, **kw: loads.append(1) or load(*a, **kw))
+
+    dev = initialize_context(request)
+    assert dev.hosts.address == ['1.1.1.1']
+    assert initialize_context(request, 'dev') is dev
+    assert len(loads) == 1
+
+    # touched but same content, no parse
+    inventory.setmtime(inventory.mtime() + 10)
+    assert initialize_context(request, 'dev') is dev
+    assert len(loads) == 1
+
+    # only the changed host group is rebuilt
+    prod = initialize_context(request, 'prod')
+    inventory.write('default: dev\n'
+                    'dev:\n  hosts:\n  - address: 1.1.1.1\n'
+                    'prod:\n  hosts:\n  - address: 4.4.4.4\n')
+    inventory.setmtime(inventory.mtime() + 20)
+    assert initialize_context(request, 'dev') is dev
+    assert initialize_context(request, 'prod').hosts.address == ['4.4.4.4']
+    assert initialize_context(request, 'prod') is not prod
+    assert len(loads) == 2
+
+    with pytest.raises(pytest.UsageError):
+        initialize_context(request, 'staging')
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import os
+import time
+
+from autostack.factcache import FactCache
+from autostack.nodes import NodeTemplate
+
+
+FACTS = {'ansible_os_family': 'RedHat',
+         'ansible_distribution': 'CentOS',
+         'ansible_distribution_major_version': '7'}
+
+
+def test_roundtrip(tmpdir):
+    cache = FactCache(str(tmpdir))
+    node = NodeTemplate('1.1.1.1', connection='ssh')
+    assert cache.get(node) is None
+    cache.set(node, FACTS)
+    assert cache.get(node) == FACTS
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_keyed_by_connection_and_user(tmpdir):
+    cache = FactCache(str(tmpdir))
+    cache.set(NodeTemplate('1.1.1.1', user='root'), FACTS)
+    assert cache.get(NodeTemplate('1.1.1.1', user='admin')) is None
+    assert cache.get(NodeTemplate('1.1.1.1', connection='local')) is None
+    assert cache.get(NodeTemplate('1.1.1.1', user='root')) == FACTS
+
+
+def test_ttl_expiry(tmpdir):
+    cache = FactCache(str(tmpdir), ttl=60)
+    node = NodeTemplate('1.1.1.1')
+    cache.set(node, FACTS)
+    filename = os.path.join(str(tmpdir), '{}.json'.format(cache.key(node)))
+    past = time.time() - 120
+    os.utime(filename, (past, past))
+    assert cache.get(node) is None
+    assert not os.path.exists(filename)
@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import pytest
+
+from autostack.nodes import Facts, NodeTemplate, RedHat, CentOS, CentOS7
+from autostack.utils import RegisterHandlers
+
+
+PAYLOAD = {'ansible_os_family': 'RedHat',
+           'ansible_default_ipv4': {'address': '1.1.1.1',
+                                    'ansible_nested': {'a': 1}},
+           'module_setup': True}
+
+
+def test_facts_view():
+    facts = Facts(PAYLOAD)
+    assert facts.os_family == 'RedHat'
+    assert facts.ansible_os_family == 'RedHat'
+    assert facts.module_setup is True
+    assert facts.default_ipv4.address == '1.1.1.1'
+    assert facts.default_ipv4.nested.a == 1
+    assert facts['ansible_default_ipv4']['address'] == '1.1.1.1'
+    assert facts == PAYLOAD
+    assert dict(facts.default_ipv4) == {'address': '1.1.1.1',
+                                        'ansible_nested': {'a': 1}}
+    with pytest.raises(KeyError):
+        facts.distribution
+    assert not hasattr(facts, '_missing')
+
+
+def test_facts_view_is_zero_copy():
+    facts = Facts(PAYLOAD)
+    assert facts._data is PAYLOAD
+    assert facts.default_ipv4 is facts.default_ipv4
+    assert facts.default_ipv4._data is PAYLOAD['ansible_default_ipv4']
+
+
+def test_handlers_table():
+    table = RegisterHandlers.table
+    for klass in (NodeTemplate, CentOS7):
+        for module_name in ('setup', 'stat', 'package_facts',
+                            'service_facts'):
+            assert (klass, module_name) in table
+    assert (NodeTemplate, 'command') not in table
+
+    node = NodeTemplate('1.1.1.1')
+    table[(NodeTemplate, 'setup')](node, {'ansible_facts': PAYLOAD})
+    table[(NodeTemplate, 'package_facts')](
+        node, {'ansible_facts': {'packages': {'bash': [{'version': '4'}]}}})
+    assert node.facts.os_family == 'RedHat'
+    assert node.facts.packages['bash'][0]['version'] == '4'
+
+    table[(NodeTemplate, 'stat')](
+        node, {'stat': {'exists': True},
+               'invocation': {'module_name': 'stat',
+                              'module_args': 'path=/etc/hosts'}})
+    assert node.stats['/etc/hosts']['exists']
+
+
+def test_concrete_os_resolution():
+    calls = []
+
+    class Probe(CentOS):
+        @classmethod
+        def is_concrete_class(cls, facts):
+            calls.append(facts.distribution)
+            return facts.distribution == 'Probe'
+
+    # deepest classes first, then by name
+    assert RedHat.concrete_classes()[:3] == [CentOS7, Probe, CentOS]
+
+    facts = {'ansible_os_family': 'RedHat', 'ansible_distribution': 'Probe',
+             'ansible_distribution_major_version': '1'}
+    for address in ('1.1.1.1', '1.1.1.2'):
+        node = NodeTemplate(address)
+        node._load_setup({'ansible_facts': facts})
+        concrete = node.get_concrete_class()
+        assert type(concrete) is Probe
+        assert concrete.address == address
+    # resolved once per fact signature
+    assert calls == ['Probe']
+
+    class Probe2(Probe):
+        @classmethod
+        def is_concrete_class(cls, facts):
+            return facts.distribution == 'Probe'
+
+    # registering a class resolves again
+    assert type(node.get_concrete_class()) is Probe2
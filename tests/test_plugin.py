@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import time
+
+import pytest
+
+from autostack import plugin
+from autostack.environment import Context
+from autostack.nodes import NodeTemplate
+
+
+class _Config(object):
+    def __init__(self, **values):
+        self.values = dict(autostack_queue='memory',
+                           autostack_codec='json',
+                           autostack_compression='none',
+                           autostack_compress_threshold=0,
+                           autostack_dispatcher_workers=1,
+                           autostack_dispatch_timeout=5,
+                           autostack_fact_staleness=0)
+        self.values.update(values)
+
+    def getvalue(self, name):
+        return self.values[name]
+
+
+class _Run(object):
+    def __init__(self):
+        self.gathered = []
+        self.refreshed = []
+
+    def setup_context(self, model, refresh=False):
+        self.gathered.append(model)
+        self.refreshed.append(refresh)
+
+
+@pytest.fixture
+def stats(monkeypatch):
+    stats = dict(runs=0, avoided=0, hosts_avoided=0)
+    monkeypatch.setattr(plugin, 'setup_stats', stats)
+    monkeypatch.setattr(plugin, 'dispatch_stats',
+                        dict(applied=0, max_depth=0, handlers={}))
+    return stats
+
+
+def _model():
+    return Context(hosts=[NodeTemplate('1.1.1.{}'.format(i))
+                          for i in range(3)])
+
+
+def _use(shared, run, name, model):
+    # what the context fixture does
+    queue, consumer, gather, expired = shared.acquire(name, model)
+    plugin._gather_facts(run, model, gather, expired)
+    if gather:
+        shared.gathered(name)
+    return consumer
+
+
+def test_shared_scope_avoids_setup(stats):
+    shared = plugin.SharedContexts(_Config())
+    run, model = _Run(), _model()
+    consumer = _use(shared, run, 'develop', model)
+    assert _use(shared, run, 'develop', model) is consumer
+    assert run.gathered == [model]
+    assert stats == dict(runs=1, avoided=1, hosts_avoided=3)
+    shared.close()
+    assert not consumer.is_alive()
+
+
+def test_shared_scope_cleared_model(stats):
+    shared = plugin.SharedContexts(_Config())
+    run, model, cleared = _Run(), _model(), _model()
+    consumer = _use(shared, run, 'develop', model)
+    # @pytest.mark.inventory(clear=True) replaced the model
+    assert _use(shared, run, 'develop', cleared) is not consumer
+    assert not consumer.is_alive()
+    assert run.gathered == [model, cleared]
+    assert stats['runs'] == 2
+    shared.close()
+
+
+def test_shared_scope_staleness(stats):
+    shared = plugin.SharedContexts(_Config(autostack_fact_staleness=0.2))
+    run, model = _Run(), _model()
+    _use(shared, run, 'develop', model)
+    _use(shared, run, 'develop', model)
+    time.sleep(0.3)
+    _use(shared, run, 'develop', model)
+    assert stats == dict(runs=2, avoided=1, hosts_avoided=3)
+    # stale facts aren't served from --autostack-fact-cache
+    assert run.refreshed == [False, True]
+    shared.close()
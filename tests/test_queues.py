@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import pytest
+
+from autostack.dispatcher import Dispatcher
+from autostack.environment import Context
+from autostack.errors import AnsibleDispatchError
+from autostack.nodes import NodeTemplate
+from autostack.queues import MemoryQueue, create_queue
+
+
+def test_memory_queue():
+    queue = MemoryQueue()
+    item = {'host': '1.1.1.1', 'result': {'rc': 0}}
+    queue.put(item)
+    queue.put_many([1, 2, 3])
+    assert len(queue) == 4
+    assert queue.get(timeout=0) is item
+    assert queue.get_batch(2, timeout=0) == [1, 2]
+    assert queue.get_batch(2, timeout=0) == [3]
+    assert queue.get_batch(2, timeout=0) == []
+    assert queue.get(block=False) is None
+    assert queue.empty()
+
+
+def test_create_queue():
+    assert isinstance(create_queue('memory', codec='json'), MemoryQueue)
+    with pytest.raises(ValueError):
+        create_queue('zmq')
+
+
+def test_dispatcher_barrier():
+    model = Context()
+    model['hosts'] = [NodeTemplate('1.1.1.{}'.format(i)) for i in range(3)]
+    queue = MemoryQueue()
+    consumer = Dispatcher(queue, model)
+    consumer.daemon = True
+    consumer.start()
+
+    facts = {'ansible_facts': {'ansible_os_family': 'RedHat'},
+             'invocation': {'module_name': 'setup'}}
+    queue.put_many([{'host': node.address, 'result': facts}
+                    for node in model.hosts])
+    queue.put({'host': '2.2.2.2', 'result': facts})
+    assert consumer.flush(timeout=5)
+    assert [node.facts.os_family for node in model.hosts] == ['RedHat'] * 3
+
+    consumer.stop(timeout=5)
+    assert not consumer.is_alive()
+    queue.put({'host': '1.1.1.1', 'result': facts})
+    assert not consumer.flush(timeout=1)
+
+
+def test_dispatcher_workers_keep_host_order():
+    model = Context()
+    model['hosts'] = [NodeTemplate('1.1.1.{}'.format(i)) for i in range(8)]
+    queue = MemoryQueue()
+    consumer = Dispatcher(queue, model, batch_size=7, workers=3)
+    consumer.daemon = True
+    consumer.start()
+
+    queue.put_many([{'host': node.address,
+                     'result': {'ansible_facts': {'seq': seq},
+                                'invocation': {'module_name': 'setup'}}}
+                    for seq in range(50) for node in model.hosts])
+    assert consumer.flush(timeout=5)
+    assert [node.facts.seq for node in model.hosts] == [49] * 8
+
+    consumer.stop(timeout=5)
+    assert not consumer.is_alive()
+    stats = consumer.stats()
+    assert stats['applied'] == 401
+    assert stats['handlers']['setup']['count'] == 400
+    assert 0 < stats['max_depth'] <= 400
+    assert consumer.depth() == 0
+
+
+def test_dispatcher_handler_errors():
+    model = Context()
+    model['hosts'] = [NodeTemplate('1.1.1.1')]
+    queue = MemoryQueue()
+    consumer = Dispatcher(queue, model)
+    consumer.daemon = True
+    consumer.start()
+
+    queue.put_many([
+        {'host': '1.1.1.1', 'result': {'invocation': {'module_name': 'ping'}}},
+        {'host': '1.1.1.1',
+         'result': {'invocation': {'module_name': 'setup'}}},
+    ])
+    assert consumer.flush(timeout=5)
+    errors = consumer.pop_errors()
+    assert [error[:2] for error in errors] == [('1.1.1.1', 'setup')]
+    assert 'KeyError' in errors[0][2]
+    assert consumer.pop_errors() == []
+    assert 'setup result of host 1.1.1.1' in str(AnsibleDispatchError(errors))
+    consumer.stop(timeout=5)
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# -*- coding: UTF-8 -*-
+
+import pytest
+
+from autostack.serializers import Serializer, CODECS, COMPRESSIONS
+
+
+ITEM = {'host': '1.1.1.1',
+        'result': {'ansible_facts': {'ansible_os_family': 'RedHat',
+                                     'ansible_mounts': [{'size': 10}] * 300},
+                   'invocation': {'module_name': 'setup'}}}
+
+
+@pytest.mark.parametrize('codec', sorted(CODECS))
+@pytest.mark.parametrize('compression', sorted(COMPRESSIONS))
+def test_roundtrip(codec, compression):
+    serializer = Serializer(codec, compression, threshold=1024)
+    assert serializer.loads(serializer.dumps(ITEM)) == ITEM
+    assert serializer.loads(serializer.dumps('goodbye')) == 'goodbye'
+
+
+def test_threshold():
+    serializer = Serializer('json', 'zlib', threshold=1024)
+    assert serializer.dumps('goodbye')[:2] == b'j-'
+    assert serializer.dumps(ITEM)[:2] == b'jz'
+
+
+def test_loads_any_compression():
+    data = Serializer('json', 'zlib', threshold=0).dumps(ITEM)
+    assert Serializer('json').loads(data) == ITEM
+
+
+def test_loads_refuses_other_codecs():
+    data = Serializer('pickle', threshold=0).dumps(ITEM)
+    with pytest.raises(ValueError):
+        Serializer('json').loads(data)
+
+
+def test_unknown_codec():
+    with pytest.raises(ValueError):
+        Serializer('yaml')
+    with pytest.raises(ValueError):
+        Serializer().loads(b'x-{}')